@@ -36,11 +36,13 @@ program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
 __version__ = "0.1.0"
 
 
+from .components import *
 from .reader import *
 from .export import *
 from .utils import *
 
 
-__all__ = (export.__all__ +
+__all__ = (components.__all__ +
+           export.__all__ +
            reader.__all__ +
            utils.__all__)
@@ -0,0 +1,316 @@
+# coding: utf-8
+"""Read data from multi-module detectors.
+
+A detector like AGIPD or LPD is recorded as one source per module, usually
+in separate files. The classes here read all modules for each train into a
+single array with a modules axis, rather than going through nested dicts of
+per-module arrays and stacking them afterwards.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+from collections import defaultdict
+from functools import reduce
+import numpy as np
+import re
+
+from .reader import FilenameInfo, SourceNameError, _roi_index
+
+__all__ = ['AGIPD1M', 'LPD1M']
+
+
+class MPxDetectorBase:
+    """Base class for megapixel detectors made of several modules.
+
+    Subclasses set ``_source_re``, which must have groups for the detector
+    name and the module number, ``_filename_name``, the detector name used
+    in file names, and ``n_modules``.
+    """
+    _source_re = None
+    _filename_name = None
+    n_modules = 16
+
+    def __init__(self, run, detector_name=None):
+        self.run = run
+        self.modules = {}  # Module number -> source name
+        self._module_files = defaultdict(list)  # Module number -> [H5File]
+
+        # Module files are named like RAW-R0450-LPD03-S00000.h5, so we only
+        # need to look at sources in files which match.
+        det_files = [f for f in run.files if self._is_module_file(f.path)]
+        if not det_files:
+            det_files = run.files  # Files renamed? Look through them all.
+
+        names = set()
+        for f in det_files:
+            for source in sorted(f.instrument_sources):
+                m = self._source_re.match(source)
+                if m is None:
+                    continue
+                name, modno = m.group(1), int(m.group(2))
+                if detector_name is not None and name != detector_name:
+                    continue
+                names.add(name)
+                if self.modules.setdefault(modno, source) != source:
+                    raise ValueError("Module {} has several sources: {}, {}"
+                                     .format(modno, self.modules[modno], source))
+                self._module_files[modno].append(f)
+
+        if not self.modules:
+            raise SourceNameError('{} detector'.format(type(self).__name__))
+        if len(names) > 1:
+            raise ValueError("Several detectors found ({}); pass detector_name"
+                             " to choose one".format(', '.join(sorted(names))))
+        self.detector_name = names.pop()
+        if max(self.modules) >= self.n_modules:
+            raise IndexError("Module {} is out of range for a detector with {}"
+                             " modules".format(max(self.modules), self.n_modules))
+
+        self._align_trains()
+
+    def _is_module_file(self, path):
+        try:
+            info = FilenameInfo(path)
+        except ValueError:  # Not named in the standard pattern
+            return False
+        return info.is_detector and info.detector_name == self._filename_name
+
+    def _align_trains(self):
+        """Find the trains with data for every module, & where to read them.
+
+        For each module, this makes arrays of (file number, index in file)
+        parallel to self.train_ids, so no lookups are needed per train.
+        """
+        module_tids = {}
+        for modno, files in self._module_files.items():
+            tids = np.concatenate([f._train_id_array for f in files])
+            file_ixs = np.repeat(np.arange(len(files)),
+                                 [len(f._train_id_array) for f in files])
+            train_ixs = np.concatenate(
+                [np.arange(len(f._train_id_array)) for f in files])
+            # If a train is in several files, use the first
+            tids, first = np.unique(tids, return_index=True)
+            module_tids[modno] = (tids, file_ixs[first], train_ixs[first])
+
+        self.train_ids = reduce(
+            np.intersect1d, [t for (t, _, _) in module_tids.values()]
+        )
+
+        self._positions = {}
+        for modno, (tids, file_ixs, train_ixs) in module_tids.items():
+            ix = np.searchsorted(tids, self.train_ids)
+            self._positions[modno] = (file_ixs[ix], train_ixs[ix])
+
+    def __repr__(self):
+        return "<{}: {} modules of {}>".format(
+            type(self).__name__, len(self.modules), self.detector_name
+        )
+
+    def _dataset_info(self, key, roi=None):
+        """Get (entry shape, dtype) for key
+
+        If roi is given, the shape is that of the region of interest.
+        """
+        entry_shape = dtype = None
+        for modno, source in self.modules.items():
+            for f in self._module_files[modno]:
+                # Opening other files may close this one, so keep only the
+                # shape & dtype, not the dataset.
+                [(_, _, ds, _, _, _)] = f._read_plan({(source, key)})
+                if entry_shape is None:
+                    entry_shape, dtype = ds.shape[1:], ds.dtype
+                elif ds.shape[1:] != entry_shape:
+                    raise ValueError("Mismatched data shapes for {}: {} and {}"
+                                     .format(key, entry_shape, ds.shape[1:]))
+
+        if roi is not None:
+            ndim = len(entry_shape) + 1
+            roi_ix = _roi_index(roi, ndim)
+            if roi_ix is None or ndim < 3:
+                raise ValueError("Can't select ROI {} in {} data {}"
+                                 .format(roi.value, key, entry_shape))
+            # Find the shape without allocating anything
+            entry_shape = np.broadcast_to(0, entry_shape)[roi_ix].shape
+        return entry_shape, dtype
+
+    def _frame_index(self, key):
+        """Get arrays (modules, trains) of the first entry & number to read
+
+        Rows for modules missing from the run are 0.
+        """
+        shape = (self.n_modules, len(self.train_ids))
+        firsts = np.zeros(shape, dtype=np.uint64)
+        counts = np.zeros(shape, dtype=np.uint64)
+        for modno, source in self.modules.items():
+            file_ixs, train_ixs = self._positions[modno]
+            for i, f in enumerate(self._module_files[modno]):
+                [(_, _, _, f_firsts, f_counts, _)] = f._read_plan({(source, key)})
+                in_file = (file_ixs == i)
+                firsts[modno, in_file] = f_firsts[train_ixs[in_file]]
+                counts[modno, in_file] = f_counts[train_ixs[in_file]]
+        return firsts, counts
+
+    def _plan_reads(self, key, pulses=None):
+        """Work out what to read for each train.
+
+        Yields (train ID, reads, frames), where reads is a list of
+        (module number, H5File, (HDF5 selection, number of frames)).
+        Trains where no module has any frames selected are skipped.
+        """
+        firsts, counts = self._frame_index(key)
+        for i, tid in enumerate(self.train_ids):
+            if pulses is None and not counts[:, i].any():
+                continue
+            reads = []
+            for modno, source in self.modules.items():
+                file_ixs, train_ixs = self._positions[modno]
+                f = self._module_files[modno][file_ixs[i]]
+                if pulses is None:
+                    first, count = int(firsts[modno, i]), int(counts[modno, i])
+                    selection = (slice(first, first + count), count)
+                else:
+                    selection = f._frame_selection(
+                        source, key, int(train_ixs[i]), pulses)
+                reads.append((modno, f, selection))
+
+            nframes = max(n for (_, _, (_, n)) in reads)
+            if nframes:
+                yield int(tid), reads, nframes
+
+    def buffer_shape(self, key='image.data', roi=None):
+        """Get the shape of an array which can hold any train of this data.
+
+        This is ``(modules, frames, ...)``, where frames is the largest number
+        of entries for one module in any train. Use it to allocate a buffer
+        to pass to :meth:`trains`. If you read a region of interest, pass the
+        same roi here.
+        """
+        entry_shape, _ = self._dataset_info(key, roi)
+        _, counts = self._frame_index(key)
+        max_count = int(counts.max()) if counts.size else 0
+        return (self.n_modules, max_count) + entry_shape
+
+    def trains(self, key='image.data', *, out=None, fill_value=None,
+               processes=0, pulses=None, roi=None):
+        """Iterate over trains, with all modules in one array.
+
+        Only trains which every module in the run has recorded are included,
+        and trains where no module has any frames are skipped. Each module's
+        data is read from HDF5 directly into its place in the output array,
+        without making intermediate arrays. This yields
+        ``(train_id, array)`` pairs, where the array has shape
+        ``(modules, frames, ...)``.
+
+        Parameters
+        ----------
+        key: str
+            The key to read for each module, e.g. 'image.data'.
+        out: numpy.ndarray, optional
+            A C-contiguous array to read each train into, e.g. allocated with
+            shape :meth:`buffer_shape`. The arrays yielded are views of this,
+            so they are overwritten by the next train; copy anything you want
+            to keep. The dtype can differ from the data in the files; HDF5
+            converts it while reading. If this is not given, a new array is
+            allocated for each train.
+        fill_value: number, optional
+            Value for modules missing from the run, and for frames a module
+            doesn't have when others have more. The default is NaN for float
+            arrays and 0 for integers.
+        processes: int
+            If this is more than 0, modules are read concurrently by this many
+            worker processes, into a buffer in shared memory. The arrays
+            yielded are reused like with ``out``, which can't be used
+            together with this.
+        pulses: by_index, by_id or by_cell object, optional
+            Read only some frames in each train, selected by position in the
+            train, by pulse ID or by memory cell ID, e.g. ``by_cell[0:4]``.
+            Only the selected frames are read from the files.
+        roi: by_index object, optional
+            Read only a region of interest in the last dimensions of each
+            frame, e.g. ``by_index[100:200, 50:60]`` for a window of pixels.
+            This is part of the HDF5 selection, so only the chunks it
+            overlaps are read and decompressed.
+        """
+        entry_shape, dtype = self._dataset_info(key, roi)
+        max_shape = self.buffer_shape(key, roi)
+        missing = [m for m in range(self.n_modules) if m not in self.modules]
+        train_reads = self._plan_reads(key, pulses)
+
+        if processes > 0:
+            if out is not None:
+                raise ValueError("out= can't be used with processes")
+            from .multiprocess import iterate_detector_mp
+            yield from iterate_detector_mp(
+                self, key, train_reads, max_shape, dtype, fill_value, missing,
+                processes, roi,
+            )
+            return
+
+        if out is not None:
+            if out.shape[0] != self.n_modules or out.shape[2:] != entry_shape:
+                raise ValueError("Output array shape {} doesn't match data {}"
+                                 .format(out.shape, max_shape))
+            if not out.flags.c_contiguous:
+                raise ValueError("Output array must be C-contiguous")
+            dtype = out.dtype
+
+        fill = fill_value
+        if fill is None:
+            fill = np.nan if dtype.kind in 'fc' else 0
+
+        if out is not None:
+            # These modules are never written, so fill them once
+            out[missing] = fill
+
+        for tid, reads, nframes in train_reads:
+            if out is None:
+                arr = np.empty((self.n_modules, nframes) + entry_shape, dtype)
+                arr[missing] = fill
+            else:
+                arr = out
+                if nframes > len(out[0]):
+                    raise ValueError("Output array has space for {} frames, "
+                                     "need {}".format(len(out[0]), nframes))
+
+            for modno, f, selection in reads:
+                f._read_into(self.modules[modno], key, selection, arr[modno],
+                             roi=roi)
+                nread = selection[1]
+                if nread < nframes:
+                    arr[modno, nread:nframes] = fill
+
+            yield tid, arr[:, :nframes]
+
+
+class AGIPD1M(MPxDetectorBase):
+    """Read data from the AGIPD 1M detector in a run.
+
+    Parameters
+    ----------
+    run: RunDirectory
+        The run containing the detector data.
+    detector_name: str, optional
+        The name of the detector, e.g. 'SPB_DET_AGIPD1M-1'. This is only
+        needed if the run has data from more than one AGIPD detector.
+    """
+    _source_re = re.compile(r'(.+_AGIPD1M.*)/DET/(\d+)CH')
+    _filename_name = 'AGIPD'
+
+
+class LPD1M(MPxDetectorBase):
+    """Read data from the LPD 1M detector in a run.
+
+    Parameters
+    ----------
+    run: RunDirectory
+        The run containing the detector data.
+    detector_name: str, optional
+        The name of the detector, e.g. 'FXE_DET_LPD1M-1'. This is only
+        needed if the run has data from more than one LPD detector.
+    """
+    _source_re = re.compile(r'(.+_LPD1M.*)/DET/(\d+)CH')
+    _filename_name = 'LPD'
@@ -0,0 +1,258 @@
+# coding: utf-8
+"""Read trains from a run in several worker processes.
+
+h5py serialises all HDF5 calls within one process, so threads can't read
+data in parallel. Here, each worker process opens the files of the run for
+itself, and reads a share of the trains. Trains are passed back to the main
+process in order. Large arrays go through shared memory (files in /dev/shm)
+rather than being pickled; the main process maps them without copying.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+from collections import deque
+import mmap
+import multiprocessing
+import numpy as np
+import os
+import uuid
+
+from .reader import H5File, RunDirectory
+
+# Arrays at least this big are passed back through shared memory
+SHARED_MEMORY_THRESHOLD = 1024 * 1024
+
+# How many trains each worker reads in one task. Detector data is ~100 MB
+# per train, so keep this small.
+TRAINS_PER_TASK = 1
+
+SHM_DIR = '/dev/shm'
+
+_worker_run = None
+
+
+class _SharedArray:
+    """Placeholder for an array passed back through shared memory"""
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+
+
+def _init_worker(file_infos):
+    global _worker_run
+    _worker_run = RunDirectory._from_files([
+        H5File(path, _cache_info=info) for (path, info) in file_infos
+    ])
+
+
+def _to_shared(arr, shm_prefix):
+    path = os.path.join(SHM_DIR, shm_prefix + uuid.uuid4().hex[:12])
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        os.ftruncate(fd, arr.nbytes)
+        with mmap.mmap(fd, arr.nbytes) as mm:
+            np.frombuffer(mm, dtype=arr.dtype).reshape(arr.shape)[...] = arr
+    finally:
+        os.close(fd)
+    return _SharedArray(path, arr.shape, arr.dtype)
+
+
+def _from_shared(sa):
+    fd = os.open(sa.path, os.O_RDWR)
+    try:
+        size = os.fstat(fd).st_size
+        mm = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+    # The memory stays mapped until the array is no longer used
+    os.unlink(sa.path)
+    return np.frombuffer(mm, dtype=sa.dtype).reshape(sa.shape)
+
+
+def _read_trains_task(train_ids, devices, pulses, roi, shm_prefix):
+    """Read a few trains in a worker process"""
+    res = []
+    for tid, data in _worker_run._iter_train_ids(train_ids, devices, pulses, roi):
+        if shm_prefix is not None:
+            for src_data in data.values():
+                for key, value in src_data.items():
+                    if isinstance(value, np.ndarray) \
+                            and value.nbytes >= SHARED_MEMORY_THRESHOLD:
+                        src_data[key] = _to_shared(value, shm_prefix)
+        res.append((tid, data))
+    return res
+
+
+def _unpack_shared(data):
+    for src_data in data.values():
+        for key, value in src_data.items():
+            if isinstance(value, _SharedArray):
+                src_data[key] = _from_shared(value)
+    return data
+
+
+def _cleanup_shared(shm_prefix):
+    """Remove shared memory files we didn't get to, e.g. if we stop early"""
+    for name in os.listdir(SHM_DIR):
+        if name.startswith(shm_prefix):
+            try:
+                os.unlink(os.path.join(SHM_DIR, name))
+            except FileNotFoundError:
+                pass
+
+
+def iterate_trains_mp(run, train_ids, devices, processes, pulses=None,
+                      roi=None):
+    """Iterate over trains from a RunDirectory, reading in worker processes.
+
+    devices must already be normalised. At most two tasks per worker are
+    queued at once, so workers don't get far ahead of the consumer.
+    """
+    if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+        shm_prefix = 'karabo_data_{}_{}_'.format(os.getpid(), uuid.uuid4().hex[:8])
+    else:
+        shm_prefix = None  # Pickle all arrays
+
+    file_infos = [(f.path, f._get_cache_info()) for f in run.files]
+    tasks = (train_ids[i:i + TRAINS_PER_TASK]
+             for i in range(0, len(train_ids), TRAINS_PER_TASK))
+
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(file_infos,))
+    try:
+        pending = deque()
+
+        def submit_next():
+            chunk = next(tasks, None)
+            if chunk is not None:
+                pending.append(pool.apply_async(
+                    _read_trains_task, (chunk, devices, pulses, roi, shm_prefix)
+                ))
+
+        for _ in range(2 * processes):
+            submit_next()
+
+        while pending:
+            result = pending.popleft().get()
+            submit_next()
+            for tid, data in result:
+                if shm_prefix is not None:
+                    data = _unpack_shared(data)
+                yield tid, data
+    finally:
+        pool.terminate()
+        pool.join()
+        if shm_prefix is not None:
+            _cleanup_shared(shm_prefix)
+
+
+# Detector reading: each worker reads some modules of each train straight
+# into a shared buffer with two slots, so one train can be read while the
+# previous one is being used.
+
+_worker_files = {}
+_worker_buffers = {}
+
+
+def _init_detector_worker(file_infos):
+    _worker_files.clear()
+    for path, info in file_infos:
+        _worker_files[path] = H5File(path, _cache_info=info)
+
+
+def _map_buffer(path, shape, dtype):
+    try:
+        return _worker_buffers[path]
+    except KeyError:
+        pass
+    fd = os.open(path, os.O_RDWR)
+    try:
+        mm = mmap.mmap(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+    buf = np.frombuffer(mm, dtype=dtype).reshape(shape)
+    _worker_buffers[path] = buf
+    return buf
+
+
+def _read_modules_task(buf_info, slot, key, reads, nframes, fill, roi):
+    """Read some modules for one train into the shared buffer"""
+    buf = _map_buffer(*buf_info)[slot]
+    for modno, source, path, selection in reads:
+        _worker_files[path]._read_into(source, key, selection, buf[modno],
+                                       roi=roi)
+        if selection[1] < nframes:
+            buf[modno, selection[1]:nframes] = fill
+
+
+def iterate_detector_mp(det, key, train_reads, shape, dtype, fill_value,
+                        missing, processes, roi=None):
+    """Iterate over detector trains, reading modules in worker processes.
+
+    The arguments are prepared by MPxDetectorBase.trains(). Modules are split
+    between the workers, so each one reads its modules for every train.
+    """
+    fill = fill_value
+    if fill is None:
+        fill = np.nan if dtype.kind in 'fc' else 0
+
+    buf_path = os.path.join(SHM_DIR, 'karabo_data_{}_{}_det'.format(
+        os.getpid(), uuid.uuid4().hex[:8]))
+    buf_shape = (2,) + shape
+    nbytes = int(np.prod(buf_shape)) * dtype.itemsize
+    fd = os.open(buf_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        os.ftruncate(fd, max(nbytes, 1))
+        mm = mmap.mmap(fd, max(nbytes, 1))
+    finally:
+        os.close(fd)
+    buf = np.frombuffer(mm, dtype=dtype, count=int(np.prod(buf_shape)))\
+        .reshape(buf_shape)
+    buf[:, missing] = fill  # These modules are never written
+    buf_info = (buf_path, buf_shape, dtype)
+
+    file_infos = {f.path: f._get_cache_info()
+                  for files in det._module_files.values() for f in files}
+    modnos = sorted(det.modules)
+    groups = [set(modnos[i::processes]) for i in range(processes)]
+    groups = [g for g in groups if g]
+
+    pool = multiprocessing.Pool(len(groups), initializer=_init_detector_worker,
+                                initargs=(list(file_infos.items()),))
+    train_reads = iter(train_reads)
+    n_submitted = 0
+
+    def submit_next():
+        nonlocal n_submitted
+        item = next(train_reads, None)
+        if item is None:
+            return None
+        tid, reads, nframes = item
+        slot = n_submitted % 2
+        n_submitted += 1
+        results = []
+        for group in groups:
+            group_reads = [(modno, det.modules[modno], f.path, selection)
+                           for (modno, f, selection) in reads if modno in group]
+            results.append(pool.apply_async(_read_modules_task, (
+                buf_info, slot, key, group_reads, nframes, fill, roi
+            )))
+        return tid, slot, nframes, results
+
+    try:
+        pending = submit_next()
+        while pending is not None:
+            tid, slot, nframes, results = pending
+            pending = submit_next()
+            for res in results:
+                res.get()
+            yield tid, buf[slot, :, :nframes]
+    finally:
+        pool.terminate()
+        pool.join()
+        os.unlink(buf_path)
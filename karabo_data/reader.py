@@ -10,21 +10,30 @@ You should have received a copy of the 3-Clause BSD License along with this
 program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
 """
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import datetime
 import fnmatch
+from functools import lru_cache
 from glob import glob
 import h5py
 import numpy as np
 import os.path as osp
 import pandas as pd
+from queue import Queue, Empty, Full
 import re
+import sys
+from threading import Event, Lock, RLock, Thread
+import weakref
 import xarray as xr
 
+from .run_files_map import RunFilesMap
 
 __all__ = ['H5File', 'RunDirectory', 'RunHandler', 'stack_data',
            'stack_detector_data', 'by_id', 'by_index', 'SourceNameError',
-           'PropertyNameError',
+           'PropertyNameError', 'TrainBatch', 'by_cell', 'TrainCache',
+           'FilePool',
           ]
 
 
@@ -45,7 +54,8 @@ class FilenameInfo:
     def __init__(self, path):
         self.basename = osp.basename(path)
         nameparts = self.basename[:-3].split('-')
-        assert len(nameparts) == 4, self.basename
+        if len(nameparts) != 4:
+            raise ValueError("Unexpected file name: {}".format(self.basename))
         rawcorr, runno, datasrc, segment = nameparts
         m = re.match(r'([A-Z]+)(\d+)', datasrc)
 
@@ -76,6 +86,11 @@ class by_index(metaclass=_SliceConstructor):
     def __init__(self, value):
         self.value = value
 
+class by_cell(metaclass=_SliceConstructor):
+    """Select detector frames by memory cell ID, e.g. ``by_cell[0:4]``"""
+    def __init__(self, value):
+        self.value = value
+
 def _tid_to_slice_ix(tid, dataset, stop=False):
     """Convert a train ID to an integer index for slicing the dataset
 
@@ -85,28 +100,242 @@ def _tid_to_slice_ix(tid, dataset, stop=False):
     if tid is None:
         return None
 
-    try:
-        return dataset.train_indices[tid]
-    except KeyError:
-        if tid < dataset.train_ids[0]:
-            if stop:
-                raise ValueError("Train ID {} is before this run (starts at {})"
-                                 .format(tid, dataset.train_ids[0]))
-            else:
-                return None
-        elif tid > dataset.train_ids[-1]:
-            if stop:
-                return None
-            else:
-                raise ValueError("Train ID {} is after this run (ends at {})"
-                                 .format(tid, dataset.train_ids[-1]))
+    train_ids = dataset._train_id_array
+    if len(train_ids) == 0:
+        return None
+    if tid < train_ids[0]:
+        if stop:
+            raise ValueError("Train ID {} is before this run (starts at {})"
+                             .format(tid, train_ids[0]))
+        else:
+            return None
+    elif tid > train_ids[-1]:
+        if stop:
+            return None
         else:
-            # This train ID is within the run, but doesn't have an entry
-            for ix, tid_cmp in enumerate(dataset.train_ids):
-                if tid_cmp > tid:
-                    return ix
+            raise ValueError("Train ID {} is after this run (ends at {})"
+                             .format(tid, train_ids[-1]))
+
+    # The first train at or after this train ID. If the train ID has no
+    # entry, this is the next train which does.
+    return int(np.searchsorted(train_ids, tid))
+
+
+class _PrefetchError:
+    def __init__(self, exc):
+        self.exc = exc
+
+_prefetch_end = object()
+
+def _prefetch(iterator, n):
+    """Consume an iterator in a background thread, up to n items ahead.
+
+    Exceptions in the background thread are re-raised in the consumer.
+    When the returned generator is closed or garbage collected, the
+    background thread stops and closes the original iterator.
+    """
+    q = Queue(maxsize=n)
+    stop = Event()
+
+    def put(item):
+        # Block until there's space or the consumer goes away
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterator:
+                if not put(item):
+                    break
+            else:
+                put(_prefetch_end)
+        except BaseException as e:
+            put(_PrefetchError(e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = Thread(target=worker, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = q.get()
+            if item is _prefetch_end:
+                return
+            elif isinstance(item, _PrefetchError):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        # Unblock the worker if it's waiting to put an item
+        try:
+            while True:
+                q.get_nowait()
+        except Empty:
+            pass
+        thread.join()
+
+
+def _train_range_to_slice(train_range, dataset):
+    """Convert a by_id or by_index train range to a slice of train indices
+
+    dataset is meant to be a H5File or RunDirectory object
+    """
+    if isinstance(train_range, by_id):
+        start_ix = _tid_to_slice_ix(train_range.value.start, dataset, stop=False)
+        stop_ix = _tid_to_slice_ix(train_range.value.stop, dataset, stop=True)
+        return slice(start_ix, stop_ix, train_range.value.step)
+    elif isinstance(train_range, by_index):
+        return train_range.value
+    elif train_range is None:
+        return slice(None, None)
+    else:
+        raise TypeError(train_range)
 
-    raise Exception("Shouldn't reach here. tid={}".format(tid))
+
+def _train_ids_for_range(train_range, dataset):
+    """Get the sorted array of train IDs selected by a train range
+
+    As well as slices, by_id and by_index objects may contain a list or
+    array of train IDs or indices. None selects all trains.
+    """
+    value = getattr(train_range, 'value', None)
+    if isinstance(train_range, by_id) and not isinstance(value, slice):
+        return np.intersect1d(dataset._train_id_array,
+                              np.asarray(value, dtype=np.uint64))
+    elif isinstance(train_range, by_index) and not isinstance(value, slice):
+        return np.unique(dataset._train_id_array[np.asarray(value)])
+    return dataset._train_id_array[_train_range_to_slice(train_range, dataset)]
+
+
+def _train_range_to_index(train_range, dataset):
+    """Convert a train range to an index into the trains of dataset
+
+    This is a slice, or a sorted array of train indices if the range has a
+    list or array of train IDs or indices.
+    """
+    value = getattr(train_range, 'value', None)
+    if isinstance(train_range, (by_id, by_index)) and not isinstance(value, slice):
+        return np.searchsorted(dataset._train_id_array,
+                               _train_ids_for_range(train_range, dataset))
+    return _train_range_to_slice(train_range, dataset)
+
+
+def _select_ids(ids, value):
+    """Find the positions in ids of IDs selected by a slice or a list"""
+    if isinstance(value, slice):
+        mask = np.ones(len(ids), dtype=bool)
+        if value.start is not None:
+            mask &= ids >= value.start
+        if value.stop is not None:
+            mask &= ids < value.stop
+        if value.step not in (None, 1):
+            mask &= (ids - (value.start or 0)) % value.step == 0
+        return mask.nonzero()[0]
+    return np.isin(ids, np.asarray(value)).nonzero()[0]
+
+
+def _positions_to_selection(first, positions):
+    """Make an HDF5 selection for sorted frame positions in one train
+
+    Evenly spaced frames become a (strided) hyperslab; anything else is
+    read with an index list.
+    """
+    if len(positions) == 0:
+        return slice(first, first)
+    start, stop = first + int(positions[0]), first + int(positions[-1]) + 1
+    if len(positions) == 1:
+        return slice(start, stop)
+    steps = np.diff(positions)
+    if (steps == steps[0]).all():
+        return slice(start, stop, int(steps[0]))
+    return first + positions
+
+
+def _roi_index(roi, ndim):
+    """Make an index for a region of interest in each entry of a dataset
+
+    roi is a by_index object selecting in the last dimensions of each entry,
+    e.g. by_index[100:200, 50:60] for pixels in images, and ndim is the
+    number of dimensions of the dataset. This returns an index to follow the
+    index on the first axis, or None if the data has too few dimensions for
+    the ROI.
+    """
+    value = roi.value if isinstance(roi.value, tuple) else (roi.value,)
+    entry_ndim = ndim - 1
+    if entry_ndim < len(value):
+        return None
+    return (slice(None),) * (entry_ndim - len(value)) + value
+
+
+def _checked_roi_index(roi, ds, key):
+    """Get the ROI index for reading one field, or () if roi is None"""
+    if roi is None:
+        return ()
+    roi_ix = _roi_index(roi, ds.ndim)
+    if roi_ix is None:
+        raise ValueError("ROI {} has more dimensions than {} data {}"
+                         .format(roi.value, key, ds.shape[1:]))
+    return roi_ix
+
+
+def _roi_for_train_data(roi, ds):
+    """Get the ROI index for a dataset when reading whole trains
+
+    When reading many keys, the ROI only applies to data with at least two
+    dimensions per entry, such as images. Returns () for other data.
+    """
+    if roi is None or ds.ndim < 3:
+        return ()
+    return _roi_index(roi, ds.ndim) or ()
+
+
+def _labelled_array(data, trainids, extra_dims=None, pulse_ids=None):
+    """Make an xarray DataArray from the data read for one field
+
+    If pulse_ids is given, the first dimension is 'train_pulse', labelled
+    with a (trainId, pulseId) MultiIndex. Otherwise it is 'trainId'.
+    """
+    if extra_dims is None:
+        extra_dims = ['dim_%d' % i for i in range(data.ndim - 1)]
+    if pulse_ids is None:
+        return xr.DataArray(data, dims=['trainId'] + extra_dims,
+                            coords={'trainId': trainids})
+
+    index = pd.MultiIndex.from_arrays([trainids, pulse_ids],
+                                      names=['trainId', 'pulseId'])
+    if hasattr(xr, 'Coordinates') and \
+            hasattr(xr.Coordinates, 'from_pandas_multiindex'):
+        coords = xr.Coordinates.from_pandas_multiindex(index, 'train_pulse')
+    else:
+        # Older xarray (before 2023.08) takes the MultiIndex directly
+        coords = {'train_pulse': index}
+    return xr.DataArray(data, dims=['train_pulse'] + extra_dims, coords=coords)
+
+
+@lru_cache(maxsize=256)
+def _glob_to_regexes(src_glob, key_glob):
+    """Compile (source, key) glob patterns to regexes.
+
+    Returns (src_re, key_re, ctrl_key_re). ctrl_key_re also matches control
+    keys with '.value' added to the end.
+    """
+    src_re = re.compile(fnmatch.translate(src_glob))
+    key_re = re.compile(fnmatch.translate(key_glob))
+    if key_glob.endswith(('.value', '*')):
+        ctrl_key_re = key_re
+    else:
+        # The translated pattern ends with "\Z" - insert before this
+        p = key_re.pattern
+        end_ix = p.rindex(r'\Z')
+        ctrl_key_re = re.compile(p[:end_ix] + r'(\.value)?' + p[end_ix:])
+    return src_re, key_re, ctrl_key_re
 
 
 def _normalize_data_selection(selection, dataset):
@@ -121,12 +350,14 @@ def _normalize_data_selection(selection, dataset):
     if isinstance(selection, set):
         return selection
 
+    all_sources = dataset.control_sources | dataset.instrument_sources
+
     res = set()
     if isinstance(selection, dict):
         # {source: {key1, key2}}
         # {source: {}} -> all keys for this source
         for source, keys in selection.items():#
-            if source not in (dataset.control_sources | dataset.instrument_sources):
+            if source not in all_sources:
                 raise ValueError("Source {} not in this run".format(source))
 
             for k in (keys or dataset._keys_for_source(source)):
@@ -135,26 +366,19 @@ def _normalize_data_selection(selection, dataset):
     elif isinstance(selection, list):
         # [('src_glob', 'key_glob'), ...]
         for src_glob, key_glob in selection:
-            # Convert glob patterns to regexes
-            src_re = re.compile(fnmatch.translate(src_glob))
-            key_re = re.compile(fnmatch.translate(key_glob))
-            if key_glob.endswith(('.value', '*')):
-                ctrl_key_re = key_re
-            else:
-                # The translated pattern ends with "\Z" - insert before this
-                p = key_re.pattern
-                end_ix = p.rindex('\Z')
-                ctrl_key_re = re.compile(p[:end_ix] + r'(\.value)?' + p[end_ix:])
+            src_re, key_re, ctrl_key_re = _glob_to_regexes(src_glob, key_glob)
 
             matched = set()
-            for source in (dataset.control_sources | dataset.instrument_sources):
+            for source in all_sources:
                 if not src_re.match(source):
                     continue
 
                 use_key_re = ctrl_key_re if (source in dataset.control_sources) else key_re
-                for key in dataset._keys_for_source(source):
-                    if use_key_re.match(key):
-                        matched.add((source, key))
+                # Keys are cached for each source, so this doesn't touch
+                # the HDF5 files after the first time.
+                matched.update((source, key) for key in
+                               filter(use_key_re.match,
+                                      dataset._keys_for_source(source)))
 
             if not matched:
                 raise ValueError("No matches for pattern {}"
@@ -167,6 +391,335 @@ def _normalize_data_selection(selection, dataset):
     return res
 
 
+def _index_group(source, key, dataset):
+    """Get the INDEX group which records the data for a source & key
+
+    Control sources have one group for all keys; instrument sources have
+    one per first part of the key, e.g. 'image' for 'image.data'.
+    """
+    if source in dataset.instrument_sources:
+        return source + '/' + key.partition('.')[0]
+    return source
+
+
+def _data_count_table(files, train_ids, selection=None):
+    """Count the data for each train & INDEX group in some files
+
+    train_ids must be sorted, and include the train IDs of all the files.
+    Returns a list of INDEX group names, and an array of counts with one row
+    per train and one column per group. If selection is given, only groups
+    used by the selected data are counted.
+    """
+    file_groups = []
+    columns = OrderedDict()  # group -> column number, in column order
+    for f in files:
+        if selection is None:
+            groups = {s.split('/', 1)[1] for s in f.sources}
+        else:
+            groups = {_index_group(src, key, f) for (src, key) in selection
+                      if src in f.all_sources}
+        file_groups.append(sorted(groups))
+        for g in file_groups[-1]:
+            columns.setdefault(g, len(columns))
+
+    counts = np.zeros((len(train_ids), len(columns)), dtype=np.uint64)
+    for f, groups in zip(files, file_groups):
+        ntrains = len(f._train_id_array)
+        rows = np.searchsorted(train_ids, f._train_id_array)
+        for g in groups:
+            _, count = f._read_index(g)
+            counts[rows, columns[g]] += count[:ntrains].astype(np.uint64)
+
+    return list(columns), counts
+
+
+def _data_counts_frame(files, train_ids, selection):
+    columns, counts = _data_count_table(files, train_ids, selection)
+    df = pd.DataFrame(counts, columns=columns,
+                      index=pd.Index(train_ids, name='trainId'))
+    return df.sort_index(axis=1)
+
+
+def _assemble_dataframe(files, fields, train_ids=None):
+    """Build a DataFrame of 1D, train-oriented fields from some files
+
+    The train IDs of each field come from the cached index of each file, and
+    every column is aligned on one sorted train ID index with searchsorted.
+    Columns of the same dtype are read into one preallocated 2D block, so
+    there is no Series per field and no joining on the index.
+    If train_ids is given, only those trains are read.
+    Fields with more than one entry per train, like pulse-resolved
+    instrument data, are indexed by (trainId, pulseId), as from get_series.
+    These can't be mixed with one-entry-per-train fields (ValueError).
+    Returns None if none of the fields are in the files.
+    """
+    pieces = defaultdict(list)  # (source, key) -> [(H5File, path, sel, tids)]
+    for f in files:
+        for source, key in f._filter_selection(fields):
+            path, sel, tids = f._field_selection(source, key, train_ids,
+                                                 check_unique=False)
+            pieces[(source, key)].append((f, path, sel, tids))
+    if not pieces:
+        return None
+
+    multi_entry = {field for (field, field_pieces) in pieces.items()
+                   if any(len(np.unique(tids)) < len(tids)
+                          for (*_, tids) in field_pieces)}
+    if multi_entry and len(multi_entry) < len(pieces):
+        raise ValueError(
+            "Can't mix fields with several entries per train ({}) and fields"
+            " with one entry per train ({}) in one DataFrame".format(
+                ', '.join('/'.join(f) for f in sorted(multi_entry)),
+                ', '.join('/'.join(f) for f in sorted(pieces.keys() - multi_entry))
+            ))
+    if multi_entry:
+        multi_series = [_multi_entry_series(field, pieces[field])
+                        for field in sorted(multi_entry)]
+        if len(multi_series) == 1:
+            return multi_series[0].to_frame()
+        for series in multi_series:
+            if not series.index.is_unique:
+                raise ValueError("{} has repeated (trainId, pulseId) entries, so"
+                                 " it can't be aligned with other fields"
+                                 .format(series.name))
+        return pd.concat(multi_series, axis=1)
+
+    index = np.unique(np.concatenate(
+        [tids for field_pieces in pieces.values() for (*_, tids) in field_pieces]
+    ))
+
+    # Group the columns by the dtype they'll have in the DataFrame
+    columns_by_dtype = defaultdict(list)
+    for field, field_pieces in sorted(pieces.items()):
+        # Files may be closed by the pool as we go, so don't keep datasets
+        dtypes = []
+        for f, path, _, _ in field_pieces:
+            ds = f.file[path]
+            if ds.ndim != 1:
+                raise ValueError("{}/{} is not 1D data per train".format(*field))
+            dtypes.append(ds.dtype)
+        dtype = np.result_type(*dtypes)
+        complete = sum(len(tids) for (*_, tids) in field_pieces) == len(index)
+        if not complete and dtype.kind in 'iu':
+            dtype = np.dtype(np.float64)  # Use NaN for missing values
+        elif not complete and dtype.kind not in 'fc':
+            # Strings & bools have no missing value; use None in an object column
+            dtype = np.dtype(object)
+        columns_by_dtype[dtype].append((field, complete))
+
+    pd_index = pd.Index(index, name='trainId')
+    frames = []
+    for dtype, dtype_columns in columns_by_dtype.items():
+        # (columns, trains) in C order is how pandas stores a block, so the
+        # DataFrame can use this array without copying it.
+        block = np.empty((len(dtype_columns), len(index)), dtype=dtype)
+        for i, (field, complete) in enumerate(dtype_columns):
+            if not complete:
+                block[i] = np.nan if dtype.kind in 'fc' else None
+            for f, path, sel, tids in pieces[field]:
+                if len(tids) == 0:
+                    continue
+                rows = np.searchsorted(index, tids)
+                contiguous = (rows[-1] - rows[0] + 1) == len(rows)
+                ds = f.file[path]
+                if contiguous and dtype.kind in 'biufc':
+                    ds.read_direct(block, sel,
+                                   np.s_[i, int(rows[0]):int(rows[-1]) + 1])
+                else:
+                    block[i, rows] = ds[sel]
+
+        names = [H5File._make_field_name(*field) for (field, _) in dtype_columns]
+        frames.append(pd.DataFrame(block.T, index=pd_index, columns=names,
+                                   copy=False))
+
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, axis=1)
+
+
+def _multi_entry_series(field, field_pieces):
+    """Read a field with several entries per train into a Series
+
+    The index has (trainId, pulseId) levels, like get_series gives.
+    """
+    source, key = field
+    field_pieces = sorted((p for p in field_pieces if len(p[3])),
+                          key=lambda p: p[3][0])
+    data, pulse_ids = [], []
+    for f, path, sel, _ in field_pieces:
+        piece_data = f.file[path][sel]
+        if piece_data.ndim == 2 and piece_data.shape[1] == 1:
+            piece_data = piece_data[:, 0]
+        if piece_data.ndim != 1:
+            raise ValueError("{}/{} is not 1D data per pulse".format(*field))
+        data.append(piece_data)
+        pulse_ids.append(f._pulse_ids_for_field(source, key, sel))
+
+    trainids = np.concatenate([tids for (*_, tids) in field_pieces])
+    index = pd.MultiIndex.from_arrays([trainids, np.concatenate(pulse_ids)],
+                                      names=['trainId', 'pulseId'])
+    return pd.Series(np.concatenate(data), index=index,
+                     name=H5File._make_field_name(source, key))
+
+
+def _complete_trains_mask(files, train_ids, selection, dataset):
+    """Get a boolean array marking trains with all of the selected data"""
+    columns, counts = _data_count_table(files, train_ids, selection)
+    col_ix = {g: i for i, g in enumerate(columns)}
+    mask = np.ones(len(train_ids), dtype=bool)
+    for g in {_index_group(src, key, dataset) for (src, key) in selection}:
+        if g not in col_ix:
+            return np.zeros(len(train_ids), dtype=bool)
+        mask &= counts[:, col_ix[g]] > 0
+    return mask
+
+
+class TrainBatch:
+    """Data from a block of trains, read together.
+
+    Iterating with :meth:`RunDirectory.train_batches` yields these, and
+    :meth:`RunDirectory.batch_from_ids` returns one.
+
+    .. attribute:: train_ids
+
+       An array of the train IDs in this batch.
+
+    .. attribute:: data
+
+       A dict of dicts, ``{source: {key: array}}``. Each array has the data
+       for all trains in the batch, concatenated along the first axis.
+
+    .. attribute:: offsets
+
+       A dict of dicts like :attr:`data`, with arrays of ``len(train_ids) + 1``
+       integers. The data for the *i*-th train in the batch is
+       ``data[src][key][offsets[src][key][i]:offsets[src][key][i+1]]``.
+    """
+    def __init__(self, train_ids, data, counts):
+        self.train_ids = train_ids
+        self.data = data
+        self.offsets = {
+            source: {key: np.concatenate(([0], np.cumsum(c, dtype=np.uint64)))
+                     for key, c in src_counts.items()}
+            for source, src_counts in counts.items()
+        }
+
+    def __len__(self):
+        return len(self.train_ids)
+
+    def train(self, i):
+        """Get one train from the batch, as returned by the ``trains()`` method
+
+        Returns (train_id, data).
+        """
+        train_id = int(self.train_ids[i])
+        train_data = defaultdict(dict)
+        for source, src_offsets in self.offsets.items():
+            for key, offsets in src_offsets.items():
+                start, end = int(offsets[i]), int(offsets[i + 1])
+                if end == start:
+                    continue
+                arr = self.data[source][key]
+                train_data[source][key] = arr[start] if end - start == 1 \
+                                          else arr[start:end]
+                train_data[source]['metadata'] = {
+                    'source': source,
+                    'timestamp.tid': train_id,
+                }
+        return train_id, train_data
+
+
+def _reorder_batch(batch, order):
+    """Make a TrainBatch with the trains of another in a different order.
+
+    order is an array of positions in batch; it may repeat trains.
+    """
+    data, counts = defaultdict(dict), defaultdict(dict)
+    for source, src_offsets in batch.offsets.items():
+        for key, offsets in src_offsets.items():
+            offsets = offsets.astype(np.int64)
+            key_counts = np.diff(offsets)[order]
+            new_starts = np.cumsum(key_counts) - key_counts
+            # The position in the old data of each entry in the new data
+            ix = np.repeat(offsets[:-1][order] - new_starts, key_counts) \
+                + np.arange(key_counts.sum())
+            data[source][key] = batch.data[source][key][ix]
+            counts[source][key] = key_counts
+    return TrainBatch(batch.train_ids[order], dict(data), dict(counts))
+
+
+def _batch_in_order(train_ids, read_batch):
+    """Read a batch of trains in the requested order.
+
+    read_batch is called with the sorted, unique train IDs, so each file &
+    dataset is read in one pass; the result is then rearranged to match.
+    """
+    train_ids = np.asarray(train_ids, dtype=np.uint64).ravel()
+    unique_ids, order = np.unique(train_ids, return_inverse=True)
+    if len(unique_ids) == 0:
+        return TrainBatch(unique_ids, {}, {})
+    batch = read_batch(unique_ids)
+    if np.array_equal(unique_ids, train_ids):
+        return batch
+    return _reorder_batch(batch, order)
+
+
+# Aim for dask chunks around this size
+DASK_CHUNK_BYTES = 128 * 1024 * 1024
+
+# Default memory limit per file for control data loaded by
+# trains(preload_control=True)
+CONTROL_PRELOAD_MAX_BYTES = 256 * 1024 * 1024
+
+
+def _preload_max_bytes(preload_control):
+    """Get the memory limit from trains(preload_control=...); 0 for none"""
+    if preload_control is True:
+        return CONTROL_PRELOAD_MAX_BYTES
+    if not preload_control:
+        return 0
+    if preload_control < 0:
+        raise ValueError("preload_control must be a bool or a number of bytes")
+    return int(preload_control)
+
+
+class _LazyDataset:
+    """Stand-in for an HDF5 dataset, for dask to read chunks from.
+
+    The dataset is looked up through the H5File for each read, so this keeps
+    working if the file pool closes the file in between. The file is pinned
+    during each read, so reads of other files in other threads can't close
+    it in the middle of one.
+    """
+    def __init__(self, h5file, path):
+        self.h5file = h5file
+        self.path = path
+        ds = h5file.file[path]
+        self.shape, self.dtype, self.ndim = ds.shape, ds.dtype, ds.ndim
+        self.hdf5_chunks = ds.chunks
+
+    def __getitem__(self, item):
+        with self.h5file._pinned() as file:
+            return file[self.path][item]
+
+
+def _dask_chunks(lazy_ds, nrows):
+    """Choose dask chunks for the first nrows of a dataset
+
+    Chunks cover whole entries (all dimensions after the first), and a
+    multiple of the HDF5 chunk size along the first axis, so each HDF5 chunk
+    is only read by one dask task.
+    """
+    entry_bytes = int(np.prod(lazy_ds.shape[1:], dtype=np.int64)) \
+        * lazy_ds.dtype.itemsize
+    rows = max(1, DASK_CHUNK_BYTES // max(entry_bytes, 1))
+    if lazy_ds.hdf5_chunks:
+        step = lazy_ds.hdf5_chunks[0]
+        rows = max(1, rows // step) * step
+    rows = max(1, min(rows, nrows))
+    return (rows,) + lazy_ds.shape[1:]
+
+
 class SourceNameError(KeyError):
     def __init__(self, source, run=True):
         self.source = source
@@ -188,6 +741,169 @@ class PropertyNameError(KeyError):
         return "No property {!r} for source {!r}".format(self.prop, self.source)
 
 
+def _default_max_open_files():
+    """Half the soft limit on open file descriptors, or 512 if unknown."""
+    try:
+        import resource
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ImportError, ValueError, OSError):
+        return 512
+    if soft == resource.RLIM_INFINITY:
+        return 512
+    return max(soft // 2, 1)
+
+
+class FilePool:
+    """Limit how many HDF5 files are held open at once.
+
+    H5File objects register here each time they use their file handle.
+    When more than *maxfiles* are open, the least recently used ones are
+    closed; they will be reopened transparently if they are needed again.
+    Files which are pinned (see :meth:`H5File._pinned`) are not closed, so
+    the limit may be exceeded while they are in use.
+
+    The pool only holds weak references, so it doesn't keep H5File objects
+    alive: a file is closed when nothing else refers to it.
+    """
+    def __init__(self, maxfiles):
+        if maxfiles < 1:
+            raise ValueError("maxfiles must be at least 1")
+        self.maxfiles = maxfiles
+        # id(H5File) -> weak reference, in order of last use
+        self._open = OrderedDict()
+        # Reentrant, because a weakref callback may run while we hold it
+        self._lock = RLock()
+
+    def touch(self, h5file):
+        """Mark a file as just used, closing others if needed."""
+        key = id(h5file)
+        with self._lock:
+            if key not in self._open:
+                self._open[key] = weakref.ref(
+                    h5file, lambda _, key=key: self._forget(key))
+            self._open.move_to_end(key)
+
+            excess = len(self._open) - self.maxfiles
+            # A weakref callback may remove entries as we go, so loop over a
+            # copy of the keys and allow for them disappearing.
+            for lru_key in list(self._open):
+                if excess <= 0 or lru_key == key:
+                    break
+                ref = self._open.get(lru_key)
+                if ref is None:
+                    excess -= 1  # Already dropped by the callback
+                    continue
+                lru = ref()
+                if lru is not None and lru._pin_count:
+                    continue
+                self._open.pop(lru_key, None)
+                excess -= 1
+                if lru is not None:
+                    # Close with the lock held, so it can't be pinned and
+                    # used between choosing it and closing it.
+                    lru._close_handle()
+
+    def pin(self, h5file):
+        with self._lock:
+            h5file._pin_count += 1
+
+    def unpin(self, h5file):
+        with self._lock:
+            h5file._pin_count -= 1
+
+    def _forget(self, key):
+        with self._lock:
+            self._open.pop(key, None)
+
+    def discard(self, h5file):
+        self._forget(id(h5file))
+
+    def __len__(self):
+        return len(self._open)
+
+
+# Shared by all H5File objects unless they are given a different pool
+default_file_pool = FilePool(_default_max_open_files())
+
+
+def _selection_key(devices):
+    """Make a hashable key from a data selection, as passed by the user"""
+    if devices is None:
+        return None
+    if isinstance(devices, dict):
+        return frozenset((src, frozenset(keys or ()))
+                         for (src, keys) in devices.items())
+    # A set holds exact (source, key) pairs, but a list holds glob patterns,
+    # so the same pairs in each can select different data. The order doesn't
+    # matter in either.
+    kind = 'pairs' if isinstance(devices, set) else 'globs'
+    return kind, frozenset(tuple(item) for item in devices)
+
+
+def _train_data_nbytes(data):
+    """Estimate the memory used by the data for one train"""
+    return sum(getattr(value, 'nbytes', 0) or sys.getsizeof(value)
+               for src_data in data.values() for value in src_data.values())
+
+
+class TrainCache:
+    """Keep recently read trains in memory, up to a number of bytes.
+
+    When adding a train would take the cache over *max_bytes*, the least
+    recently used trains are dropped. Trains bigger than the limit are not
+    stored. The *hits* and *misses* attributes count lookups, to help choose
+    a size.
+    """
+    def __init__(self, max_bytes):
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be at least 1")
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._trains = OrderedDict()  # key -> (data, nbytes), in order of use
+        self._lock = Lock()
+
+    def get(self, key):
+        """Get the data for a key, or None if it is not cached."""
+        with self._lock:
+            try:
+                data, _ = self._trains[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._trains.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        nbytes = _train_data_nbytes(data)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._trains:
+                self.nbytes -= self._trains.pop(key)[1]
+            self._trains[key] = (data, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, lru_nbytes) = self._trains.popitem(last=False)
+                self.nbytes -= lru_nbytes
+
+    def clear(self):
+        """Drop all cached trains, and reset the statistics."""
+        with self._lock:
+            self._trains.clear()
+            self.nbytes = self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._trains)
+
+    def __repr__(self):
+        return "<TrainCache: {} trains, {}/{} bytes, {} hits, {} misses>".format(
+            len(self), self.nbytes, self.max_bytes, self.hits, self.misses
+        )
+
+
 class H5File:
     """Access an HDF5 file generated at European XFEL.
 
@@ -205,6 +921,9 @@ class H5File:
     driver: str, optional
         Driver option for h5py. You should usually not set this.
         http://docs.h5py.org/en/latest/high/file.html#file-drivers
+    pool: FilePool, optional
+        Limits the number of open files. By default, a pool shared by all
+        files is used, allowing up to half the process' file descriptor limit.
 
     Raises
     ------
@@ -213,20 +932,34 @@ class H5File:
     ValueError
         If the path exists but is not an HDF5 file
     """
-    def __init__(self, path, driver=None):
+    _pin_count = 0
+
+    def __init__(self, path, driver=None, pool=None, _cache_info=None):
         self.path = path
-        if not osp.isfile(path):
-            raise FileNotFoundError(path)
-        if not h5py.is_hdf5(path):
-            raise ValueError('%s is not a valid HDF5 file.' % path)
-        self.file = h5py.File(path, 'r', driver=driver)
-
-        self.metadata = self.file[METADATA]
-        self.index = self.file[INDEX_DATA]
-        self.run = self.file[RUN_DATA]
-
-        self.sources = [source.decode() for source in
-                        self.metadata['dataSourceId'].value if source]
+        self._driver = driver
+        self._pool = default_file_pool if pool is None else pool
+        self._file = None
+        self._index_cache = {}
+        self._keys_cache = {}
+        self._read_plans = {}
+        self._catalog = None
+
+        if _cache_info:
+            # Metadata from a run map: don't open the file until we read data
+            sources = _cache_info['sources']
+            train_ids = _cache_info['train_ids']
+            self._index_cache.update(_cache_info['index'])
+            self._keys_cache.update(_cache_info['keys'])
+        else:
+            if not osp.isfile(path):
+                raise FileNotFoundError(path)
+            if not h5py.is_hdf5(path):
+                raise ValueError('%s is not a valid HDF5 file.' % path)
+            sources = [source.decode() for source in
+                       self.metadata['dataSourceId'][()] if source]
+            train_ids = self.index['trainId'][()]
+
+        self.sources = sources
         self.control_sources = set()
         self.instrument_sources = set()
         for src in self.sources:
@@ -238,11 +971,63 @@ class H5File:
             else:
                 raise ValueError("Unknown data category %r" % category)
 
-        self.train_ids = [tid for tid in self.index['trainId'][()].tolist()
-                          if tid != 0]
+        # INDEX/trainId as in the file, with any zeros, to map index entries
+        self._index_train_ids = np.asarray(train_ids, dtype=np.uint64)
+        self._train_id_array = self._index_train_ids[self._index_train_ids != 0]
+        self.train_ids = self._train_id_array.tolist()
         self.train_indices = {tid: idx for idx, tid in enumerate(self.train_ids)}
 
-        self._index_cache = {}
+    def _get_cache_info(self):
+        """Get the metadata we have for this file, to recreate it elsewhere.
+
+        The result can be passed as the _cache_info parameter to make a
+        new H5File object without reading metadata from the file.
+        """
+        return {
+            'sources': self.sources,
+            'train_ids': self._index_train_ids,
+            'index': dict(self._index_cache),
+            'keys': dict(self._keys_cache),
+        }
+
+    @property
+    def file(self):
+        """The h5py File object, opened when it is first needed.
+
+        The file may be closed again if too many files are open
+        (see :class:`FilePool`). Any h5py objects from it, such as datasets,
+        then stop working. So don't keep them while accessing other files,
+        unless the file is pinned with :meth:`_pinned`.
+        """
+        if self._file is None:
+            self._file = h5py.File(self.path, 'r', driver=self._driver)
+        self._pool.touch(self)
+        return self._file
+
+    @contextmanager
+    def _pinned(self):
+        """Keep this file open inside a with block.
+
+        The file pool won't close it, even while other files are used.
+        Yields the h5py File object.
+        """
+        self._pool.pin(self)
+        try:
+            yield self.file
+        finally:
+            self._pool.unpin(self)
+
+    @property
+    def metadata(self):
+        return self.file[METADATA]
+
+    @property
+    def index(self):
+        return self.file[INDEX_DATA]
+
+    @property
+    def run(self):
+        return self.file[RUN_DATA]
 
     @property
     def all_sources(self):
@@ -262,36 +1047,19 @@ class H5File:
             return category, h5_device, ''
 
     def _keys_for_source(self, source):
-        res = set()
-        def add_key(key, value):
-            if isinstance(value, h5py.Dataset):
-                res.add(key.replace('/', '.'))
-
-        if source in self.control_sources:
-            self.file['/CONTROL/' + source].visititems(add_key)
-        elif source in self.instrument_sources:
-            self.file['/INSTRUMENT/' + source].visititems(add_key)
-        else:
-            raise KeyError("Source {} not in file".format(source))
-        return res
-
-    def _check_data_missing(self, selection, tid):
-        missing = set()
-        for source, key in selection:
-            if source in self.instrument_sources:
-                key_head, _, h5_key = key.partition('.')
-                h5_source = source + '/' + key_head
-            elif source in self.control_sources:
-                h5_source = source
-            else:
-                missing.add((source, key))
-                continue
-
-            _, count = self._read_index(h5_source, self.train_indices[tid])
-            if count < 1:
-               missing.add((source, key))
+        try:
+            return self._keys_cache[source]
+        except KeyError:
+            if source not in self.all_sources:
+                raise KeyError("Source {} not in file".format(source))
 
-        return missing
+        # Fill in the keys for all sources from the dataset catalog, so the
+        # file is only walked once.
+        for src in self.all_sources:
+            self._keys_cache.setdefault(src, set())
+        for src, key, *_ in self._dataset_catalog():
+            self._keys_cache[src].add(key)
+        return self._keys_cache[source]
 
     def _filter_selection(self, selection=None):
         """Filter sources in this file from selected data for a run.
@@ -302,79 +1070,327 @@ class H5File:
         return {(src, key) for (src, key) in selection
                 if src in (self.instrument_sources | self.control_sources)}
 
-    def _gen_train_data(self, train_index, only_this=None):
-        """Get data for the specified index in file.
+    def _dataset_catalog(self):
+        """List every dataset in the file, with the index group it uses.
+
+        Returns a list of (source, key, path, h5_source, data_source) tuples,
+        where data_source is the entry in METADATA/dataSourceId. The HDF5
+        tree is only walked the first time this is called.
         """
-        train_data = defaultdict(dict)
+        if self._catalog is not None:
+            return self._catalog
 
-        train_id = self.train_ids[train_index]
+        catalog = []
+        for data_source in self.sources:
+            _, device, path_base = self._parse_data_src(data_source)
+            h5_source = data_source.split('/', 1)[1]
+
+            def add_dataset(name, value):
+                if isinstance(value, h5py.Dataset):
+                    key = '.'.join(filter(None,
+                                   (path_base,) + tuple(name.split('/'))))
+                    catalog.append((device, key, data_source + '/' + name,
+                                    h5_source, data_source))
+
+            self.file[data_source].visititems(add_dataset)
 
-        if only_this is not None:
-            for source, key in only_this:
-                h5_source, h5_key = source, key
+        self._catalog = catalog
+        return catalog
+
+    def _read_plan(self, selection=None):
+        """Find the datasets & index arrays to read selected data.
+
+        Returns a list of (source, key, dataset, first, count, data_source)
+        tuples, where first & count are the index arrays for all trains.
+        If selection is None, the plan covers every dataset in the file.
+        The plan for each selection is cached until the file is closed.
+        """
+        file = self.file  # Opens the file if needed
+        plan_key = None if selection is None else frozenset(selection)
+        try:
+            return self._read_plans[plan_key]
+        except KeyError:
+            pass
+
+        if selection is None:
+            entries = self._dataset_catalog()
+        else:
+            entries = []
+            for source, key in selection:
                 if source in self.instrument_sources:
-                    key_head, _, h5_key = key.partition('.')
-                    h5_source = source + '/' + key_head
+                    h5_source = source + '/' + key.partition('.')[0]
                     path = '/INSTRUMENT/{}/{}'.format(source, key.replace('.', '/'))
                 else:
+                    h5_source = source
                     path = '/CONTROL/{}/{}'.format(source, key.replace('.', '/'))
+                entries.append((source, key, path, h5_source, source))
 
-                # Which parts of the data to get for this train:
-                first, count = self._read_index(h5_source, train_index)
+        plan = []
+        for source, key, path, h5_source, data_source in entries:
+            first, count = self._read_index(h5_source)
+            plan.append((source, key, file[path], first, count, data_source))
 
-                if not count:
-                    # No data here
-                    continue
+        self._read_plans[plan_key] = plan
+        return plan
 
-                ds = self.file[path]
-                if count == 1:
-                    data = ds[first]
-                else:
-                    data = ds[first:first + count, ]
-                train_data[source][key] = data
+    def _gen_train_data(self, train_index, only_this=None, pulses=None,
+                        roi=None, preloaded=None):
+        """Get data for the specified index in file.
 
-                train_data[source]['metadata'] = {
-                    'source': source,
-                    'timestamp.tid': train_id,
-                }
-            return train_id, train_data
+        preloaded is a dict of arrays from _preload_control(), if any.
+        Data in it is sliced from memory instead of read from the file.
+        """
+        train_data = defaultdict(dict)
 
-        for source in self.sources:
-            h5_source = source.split('/', 1)[1]
-            index = self.index[h5_source]
-            table = self.file[source]
+        train_id = self.train_ids[train_index]
+        pulse_sels = {}  # (source, key group) -> selection
 
+        for source, key, ds, firsts, counts, data_source \
+                in self._read_plan(only_this):
             # Which parts of the data to get for this train:
-            first, count = self._read_index(h5_source, train_index)
-
-            category, device, path_base = self._parse_data_src(source)
+            first, count = firsts[train_index], counts[train_index]
 
             if not count:
+                # No data here
                 continue
 
-            data = train_data[device]
+            group_id = (source, key.partition('.')[0])
+            if pulses is not None and group_id not in pulse_sels:
+                pulse_sels[group_id] = self._pulse_selection(
+                    source, key, train_index, pulses)
 
-            def append_data(key, value):
-                if isinstance(value, h5py.Dataset):
-                    path = '.'.join(filter(None,
-                                    (path_base,) + tuple(key.split('/'))))
+            roi_ix = _roi_for_train_data(roi, ds)
+            if preloaded is not None and (source, key) in preloaded:
+                arr = preloaded[source, key]
+                if count == 1:
+                    data = arr[(first,) + roi_ix]
+                else:
+                    data = arr[(slice(first, first + count),) + roi_ix]
+            elif pulse_sels.get(group_id) is not None:
+                data = ds[(pulse_sels[group_id][0],) + roi_ix]
+            elif count == 1:
+                data = ds[(first,) + roi_ix]
+            else:
+                data = ds[(slice(first, first + count),) + roi_ix]
+            train_data[source][key] = data
+
+            train_data[source]['metadata'] = {
+                'source': data_source,
+                'timestamp.tid': train_id,
+            }
 
-                    if count == 1:
-                        data[path] = value[first]
+        return train_id, train_data
+
+    def _preload_control(self, selection=None, max_bytes=None):
+        """Read selected control datasets into memory, for iterating trains.
+
+        Each control key is a small value per train, so reading them one
+        train at a time means many tiny HDF5 reads. Returns a dict of
+        {(source, key): array}. Datasets are loaded until they would take
+        more than max_bytes (default CONTROL_PRELOAD_MAX_BYTES); any others
+        are read from the file as usual.
+        """
+        if max_bytes is None:
+            max_bytes = CONTROL_PRELOAD_MAX_BYTES
+        preloaded = {}
+        total = 0
+        for source, key, ds, _, _, _ in self._read_plan(selection):
+            if source not in self.control_sources:
+                continue
+            nbytes = ds.size * ds.dtype.itemsize
+            if total + nbytes > max_bytes:
+                continue
+            preloaded[source, key] = ds[:]
+            total += nbytes
+        return preloaded
+
+    def _pulse_selection(self, source, key, train_index, pulses):
+        """Find which frames of one train to read for a pulse selection.
+
+        pulses is a by_index, by_id (pulse ID) or by_cell (cell ID) object.
+        This applies to instrument data recorded per pulse, i.e. in a group
+        of keys with pulseId, such as 'image'. Returns None for other data,
+        or (HDF5 selection, number of frames).
+        """
+        group = key.partition('.')[0]
+        if source not in self.instrument_sources or \
+                group + '.pulseId' not in self._keys_for_source(source):
+            return None
+
+        first, count = self._read_index(source + '/' + group, train_index)
+        first, count = int(first), int(count)
+        if isinstance(pulses, by_index):
+            if isinstance(pulses.value, slice):
+                positions = np.arange(count)[pulses.value]
+            else:
+                # Negative positions count from the end, like a slice;
+                # positions past the end raise IndexError.
+                positions = np.arange(count)[
+                    np.atleast_1d(pulses.value).astype(np.int64)]
+        elif isinstance(pulses, (by_id, by_cell)):
+            id_key = 'pulseId' if isinstance(pulses, by_id) else 'cellId'
+            ids_ds = self.file['/INSTRUMENT/{}/{}/{}'.format(source, group, id_key)]
+            ids = ids_ds[first:first + count].reshape(count)
+            positions = _select_ids(ids, pulses.value)
+        else:
+            raise TypeError(pulses)
+
+        positions = np.unique(positions)
+        return _positions_to_selection(first, positions), len(positions)
+
+    def _frame_selection(self, source, key, train_index, pulses=None):
+        """Get (HDF5 selection, number of entries) for one train's data"""
+        if pulses is not None:
+            sel = self._pulse_selection(source, key, train_index, pulses)
+            if sel is not None:
+                return sel
+        [(_, _, _, firsts, counts, _)] = self._read_plan({(source, key)})
+        first, count = int(firsts[train_index]), int(counts[train_index])
+        return slice(first, first + count), count
+
+    def _read_into(self, source, key, selection, out, roi=None):
+        """Read selected entries of one dataset into the start of out.
+
+        selection is (HDF5 selection, number of entries), as from
+        _frame_selection. This uses HDF5's read_direct, so it doesn't make
+        an intermediate array. out must be a C-contiguous array with
+        enough space.
+        """
+        sel, n = selection
+        if n > len(out):
+            raise ValueError("Output array has space for {} entries, need {}"
+                             .format(len(out), n))
+        if n:
+            [(_, _, ds, _, _, _)] = self._read_plan({(source, key)})
+            ds.read_direct(out, (sel,) + _roi_for_train_data(roi, ds),
+                           np.s_[0:n])
+
+    def _read_trains(self, train_ixs, only_this=None):
+        """Read data for several trains at once.
+
+        train_ixs is a sorted array of train indices in this file. Where the
+        data for these trains is close together, each dataset is read with
+        one HDF5 selection covering all of them.
+
+        Returns {source: {key: (data, counts)}}, where counts has the number
+        of entries in data for each train. Data which has no entries for any
+        of these trains is left out.
+        """
+        res = defaultdict(dict)
+        for source, key, ds, firsts, counts, _ in self._read_plan(only_this):
+            count = counts[train_ixs].astype(np.int64)
+            nonzero = count > 0
+            if not nonzero.any():
+                continue
+
+            starts = firsts[train_ixs].astype(np.int64)[nonzero]
+            ends = starts + count[nonzero]
+            lo, hi = starts.min(), ends.max()
+            n_wanted = count.sum()
+
+            if (starts[0] == lo) and (ends[-1] == hi) \
+                    and (starts[1:] == ends[:-1]).all():
+                # Contiguous - the common case
+                data = ds[lo:hi]
+            elif (hi - lo) <= 2 * n_wanted:
+                # Small gaps: read the whole block and pick out what we want
+                block = ds[lo:hi]
+                data = block[np.concatenate([
+                    np.arange(a, b) for (a, b) in zip(starts, ends)
+                ]) - lo]
+            else:
+                # Data is spread out, e.g. selecting every 10th train. Read
+                # each run of consecutive trains with one selection.
+                breaks = (starts[1:] != ends[:-1]).nonzero()[0] + 1
+                run_starts = starts[np.concatenate(([0], breaks))]
+                run_ends = ends[np.concatenate((breaks - 1, [len(ends) - 1]))]
+                data = np.empty((n_wanted,) + ds.shape[1:], dtype=ds.dtype)
+                pos = 0
+                for a, b in zip(run_starts.tolist(), run_ends.tolist()):
+                    if ds.dtype.hasobject:  # e.g. strings; no read_direct
+                        data[pos:pos + b - a] = ds[a:b]
                     else:
-                        data[path] = value[first:first + count, ]
+                        ds.read_direct(data, np.s_[a:b], np.s_[pos:pos + b - a])
+                    pos += b - a
 
-            table.visititems(append_data)
+            res[source][key] = (data, count)
+        return res
 
+    def train_batches(self, batch_size, devices=None, train_range=None):
+        """Iterate over the file in batches of several trains.
 
-            train_data[device]['metadata'] = {
-                'source': source,
-                'timestamp.tid': train_id,
-            }
+        This reads each dataset once per batch, rather than once per train,
+        which is much faster for small pieces of data, like control data.
+        Each batch is a :class:`TrainBatch` object.
 
-        return train_id, train_data
+        Parameters
+        ----------
+        batch_size: int
+            The number of trains in each batch. The last batch may be smaller.
+        devices: dict or list, optional
+            Filter data by sources and by parameters.
+            Refer to :meth:`trains` for how to use this.
+        train_range: by_id or by_index object, optional
+            Iterate over only selected trains, by train ID or by index.
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        train_ix = _train_range_to_index(train_range, self)
+        if devices:
+            devices = _normalize_data_selection(devices, self)
+
+        train_ixs = np.arange(len(self.train_ids))[train_ix]
+        for start in range(0, len(train_ixs), batch_size):
+            batch_ixs = train_ixs[start:start + batch_size]
+            file_data = self._read_trains(batch_ixs, devices)
+            yield self._make_batch(batch_ixs, file_data)
+
+    def _make_batch(self, train_ixs, file_data):
+        return TrainBatch(
+            self._train_id_array[train_ixs],
+            {src: {k: d for k, (d, _) in kd.items()}
+             for src, kd in file_data.items()},
+            {src: {k: c for k, (_, c) in kd.items()}
+             for src, kd in file_data.items()},
+        )
+
+    def batch_from_ids(self, train_ids, devices=None):
+        """Read any set of trains together, as a :class:`TrainBatch`.
+
+        The trains are read in order of train ID, so each dataset is read
+        with as few HDF5 selections as possible, and then arranged in the
+        order given. This is much faster than calling :meth:`train_from_id`
+        in a loop.
 
-    def trains(self, devices=None, train_range=None, *, require_all=False):
+        Parameters
+        ----------
+        train_ids: array or list of int
+            The train IDs to read. These can be in any order.
+        devices: dict or list, optional
+            Filter data by sources and by parameters.
+            Refer to :meth:`trains` for how to use this.
+
+        Raises
+        ------
+        KeyError
+            if any of the train IDs are not in the file.
+        """
+        if devices:
+            devices = _normalize_data_selection(devices, self)
+
+        def read_batch(unique_ids):
+            missing = ~np.isin(unique_ids, self._train_id_array)
+            if missing.any():
+                raise KeyError("trains {} not found in {}".format(
+                    unique_ids[missing].tolist(), self.path))
+            train_ixs = np.searchsorted(self._train_id_array, unique_ids)
+            return self._make_batch(train_ixs,
+                                    self._read_trains(train_ixs, devices))
+
+        return _batch_in_order(train_ids, read_batch)
+
+    def trains(self, devices=None, train_range=None, *, require_all=False,
+               prefetch=0, pulses=None, roi=None, preload_control=False):
         """Iterate over all trains in the file.
 
         Parameters
@@ -402,11 +1418,49 @@ class H5File:
 
                 f.trains(train_range=by_index[20:])
 
+            This can also be a list or array of train IDs or indices, e.g.
+            ``by_id[tids]``, to read only those trains.
+
         require_all: bool
             False (default) returns any data available for the requested trains.
             True skips trains which don't have all the requested data;
             this requires that you specify required data using *devices*.
 
+        prefetch: int
+            If this is more than 0, read up to this many trains ahead in a
+            background thread, so reading data overlaps with your processing.
+            Prefetched trains are held in memory until you use them.
+
+        pulses: by_index, by_id or by_cell object, optional
+            Read only some frames of detector data in each train, selected
+            by position in the train, by pulse ID or by memory cell ID::
+
+                f.trains(pulses=by_cell[0:4])
+
+            Only the selected frames are read from the file. This applies to
+            instrument data recorded per pulse (with a pulseId key alongside
+            it); other data is read as usual.
+
+        roi: by_index object, optional
+            Read only a region of interest in the last dimensions of each
+            entry, e.g. a window of pixels in detector images::
+
+                f.trains(roi=by_index[100:200, 50:60])
+
+            The ROI is part of the HDF5 selection, so with chunked data, only
+            the chunks it overlaps are read and decompressed. It applies to
+            data with at least 2 dimensions per entry, such as images.
+
+        preload_control: bool or int
+            If True, read the selected control data for all trains into
+            memory first, and take each train's values from there, rather
+            than reading each value from the file separately. This is much
+            faster when iterating over slow data. Arrays in the train data
+            may be views of the preloaded data, so don't modify them.
+            Up to 256 MiB are preloaded per file by default; pass a number
+            of bytes instead of True to change this. Control data beyond the
+            limit is read train by train.
+
         Examples
         --------
 
@@ -430,30 +1484,38 @@ class H5File:
         it's parameters (pulseEnergy and beamPosition), sample_x and
         sample_y (with all of their parameters). All other devices are ignored.
         """
-        if isinstance(train_range, by_id):
-            start_ix = _tid_to_slice_ix(train_range.value.start, self, stop=False)
-            stop_ix = _tid_to_slice_ix(train_range.value.stop, self, stop=True)
-            ix_slice = slice(start_ix, stop_ix, train_range.value.step)
-        elif isinstance(train_range, by_index):
-            ix_slice = train_range.value
-        elif train_range is None:
-            ix_slice = slice(None, None)
-        else:
-            raise TypeError(train_range)
+        if prefetch:
+            yield from _prefetch(self.trains(devices, train_range,
+                                             require_all=require_all,
+                                             pulses=pulses, roi=roi,
+                                             preload_control=preload_control),
+                                 prefetch)
+            return
+
+        train_ix = _train_range_to_index(train_range, self)
 
         if devices:
             devices = _normalize_data_selection(devices, self)
         elif require_all:
             raise ValueError("Cannot skip partial data without devices= parameter")
 
-        for tid in self.train_ids[ix_slice]:
-            if require_all and self._check_data_missing(devices, tid):
-                continue
+        train_ixs = np.arange(len(self.train_ids))[train_ix]
+        if require_all:
+            mask = _complete_trains_mask([self], self._train_id_array,
+                                         devices, self)
+            train_ixs = train_ixs[mask[train_ix]]
+
+        preloaded = None
+        preload_bytes = _preload_max_bytes(preload_control)
+        if preload_bytes and len(train_ixs):
+            preloaded = self._preload_control(devices, preload_bytes)
 
-            index = self.train_indices[tid]
-            yield self._gen_train_data(index, only_this=devices)
+        for index in train_ixs:
+            yield self._gen_train_data(int(index), only_this=devices,
+                                       pulses=pulses, roi=roi,
+                                       preloaded=preloaded)
 
-    def train_from_id(self, train_id, devices=None):
+    def train_from_id(self, train_id, devices=None, *, pulses=None, roi=None):
         """Get Train data for specified train ID.
 
         Parameters
@@ -464,6 +1526,10 @@ class H5File:
             Filter data by devices and by parameters.
 
             Refer to :meth:`~.H5File.trains` for how to use this.
+        pulses: by_index, by_id or by_cell object, optional
+            Read only some detector frames; see :meth:`trains`.
+        roi: by_index object, optional
+            Read only a region of interest in images; see :meth:`trains`.
 
         Returns
         -------
@@ -485,11 +1551,12 @@ class H5File:
             index = self.train_indices[train_id]
         except KeyError:
             raise KeyError("train {} not found in {}.".format(
-                            train_id, self.file.filename))
+                            train_id, self.path))
         else:
-            return self._gen_train_data(index, only_this=devices)
+            return self._gen_train_data(index, only_this=devices,
+                                        pulses=pulses, roi=roi)
 
-    def train_from_index(self, index, devices=None):
+    def train_from_index(self, index, devices=None, *, pulses=None, roi=None):
         """Get train data of the nth train in file.
 
         Parameters
@@ -500,6 +1567,10 @@ class H5File:
             Filter data by devices and by parameters.
 
             Refer to :meth:`~.H5File.trains` for how to use this.
+        pulses: by_index, by_id or by_cell object, optional
+            Read only some detector frames; see :meth:`trains`.
+        roi: by_index object, optional
+            Read only a region of interest in images; see :meth:`trains`.
 
         Returns
         -------
@@ -512,7 +1583,8 @@ class H5File:
         if devices is not None:
             devices = _normalize_data_selection(devices, self)
 
-        return self._gen_train_data(index, only_this=devices)
+        return self._gen_train_data(index, only_this=devices, pulses=pulses,
+                                    roi=roi)
 
     @staticmethod
     def _make_field_name(device, key):
@@ -553,32 +1625,97 @@ class H5File:
             count = np.uint64((ix_group['last'][:] - first + 1) * status)
         return first, count
 
-    def _index_to_trainids(self, ix_group, check_unique=True):
-        if 'count' in ix_group:
-            count = ix_group['count'][:]
-        else:
-            first = ix_group['first'][:]
-            count = (ix_group['last'][:] - first + 1) * ix_group['status'][:]
+    def _index_to_trainids(self, h5_source, check_unique=True):
+        """Get the train ID for each entry of data recorded in an INDEX group
+
+        This uses the cached index & train IDs, so it doesn't read the file
+        after the first time.
+        """
+        _, count = self._read_index(h5_source)
 
         if check_unique and (count > 1).any():
-            data_src = ix_group.name.split('INDEX/', 1)[1]
-            raise ValueError("%s data has more than one data point per train" % data_src)
+            raise ValueError("%s data has more than one data point per train" % h5_source)
 
-        trainId = self.index['trainId'][:]
+        trainId = self._index_train_ids
         n = min(len(count), len(trainId))
 
-        res = np.repeat(trainId[:n], count.astype(np.intp)[:n])
+        res = np.repeat(trainId[:n], count[:n].astype(np.intp))
 
         # The output should contain valid train IDs, without zeroes.
         # If not, something has gone wrong, and it needs to be debugged.
         if (res == 0).any():
-            data_src = ix_group.name.split('INDEX/', 1)[1]
             raise ValueError("Error calculating train IDs for %s: 0 in index"
-                             % data_src)
+                             % h5_source)
 
         return res
 
-    def get_series(self, device, key):
+    def data_counts(self, devices=None):
+        """Count the data recorded for each train & source.
+
+        This only reads the INDEX section of the file, not the data itself::
+
+            counts = f.data_counts()
+            usable = counts.index[(counts > 0).all(axis=1)]
+
+        Parameters
+        ----------
+        devices: dict or list, optional
+            Only count data for these devices and parameters.
+            Refer to :meth:`trains` for how to use this.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Indexed by train ID, with a column for each control source, and
+            one for each group of keys of an instrument source, e.g.
+            ``"FXE_DET_LPD1M-1/DET/0CH0:xtdf/image"``, which are recorded
+            separately.
+        """
+        if devices is not None:
+            devices = _normalize_data_selection(devices, self)
+        return _data_counts_frame([self], self._train_id_array, devices)
+
+    def _field_info(self, device, key, check_unique=True):
+        """Find the dataset and the train ID of each entry for a field.
+
+        Returns (HDF5 path, train IDs). The field's data is in the first
+        len(train IDs) entries of the dataset. This only reads the index.
+        """
+        if ':' in device:  # INSTRUMENT data
+            keyhead, _, subkey = key.partition('.')
+            data_path = "/INSTRUMENT/{}/{}/{}".format(
+                device, keyhead, subkey.replace('.', '/'))
+            trainids = self._index_to_trainids(device + '/' + keyhead,
+                                               check_unique=check_unique)
+        else:
+            data_path = "/CONTROL/{}/{}".format(device, key.replace('.', '/'))
+            trainids = self._train_id_array
+        return data_path, trainids
+
+    def _field_selection(self, device, key, train_ids=None, check_unique=True):
+        """Find which entries of a field to read for selected trains.
+
+        Returns (HDF5 path, selection on the first axis, train IDs of the
+        selected entries). If train_ids is None, all entries are selected.
+        """
+        path, tids = self._field_info(device, key, check_unique)
+        if train_ids is None:
+            return path, slice(0, len(tids)), tids
+        positions = np.isin(tids, train_ids).nonzero()[0]
+        return path, _positions_to_selection(0, positions), tids[positions]
+
+    def _pulse_ids_for_field(self, device, key, selection):
+        """Read the pulse IDs for selected entries of an instrument field"""
+        keyhead = key.partition('.')[0]
+        path = '/INSTRUMENT/{}/{}/pulseId'.format(device, keyhead)
+        if ':' not in device or path not in self.file:
+            raise ValueError("{}/{} data has no pulse IDs".format(device, key))
+        pulse_id = self.file[path]
+        if pulse_id.ndim > 1:
+            return pulse_id[selection, 0]
+        return pulse_id[selection]
+
+    def get_series(self, device, key, train_range=None):
         """Return a pandas Series for a particular data field.
 
         Parameters
@@ -590,45 +1727,32 @@ class H5File:
         key: str
             Key of parameter within that device, e.g. "beamPosition.iyPos.value"
             or "header.linkId". The data must be 1D in the file.
+        train_range: by_id or by_index object, optional
+            Read only data for some trains, e.g. ``by_index[::10]`` for every
+            10th train, or ``by_id[10000:10100]``.
         """
         self._check_field(device, key)
         name = self._make_field_name(device, key)
 
-        # Find the data
-        if ':' in device:  # INSTRUMENT data
-            keyhead, _, key = key.partition('.')
-            device += '/' + keyhead
-            data_src = 'INSTRUMENT/' + device
-        else:
-            data_src = 'CONTROL/' + device
-        data_path = "/{}/{}".format(data_src, key.replace('.', '/'))
-        ds = self.file[data_path]
-
-        # Get the index
-        if data_src.startswith('CONTROL'):
-            index_ds = self.index['trainId']
-            index = pd.Index(index_ds[index_ds[:] != 0], name='trainId')
-            data = ds[:len(index)]
-        elif data_src.startswith('INSTRUMENT'):
-            trainids = self._index_to_trainids(self.index[device],
-                                               check_unique=False)
-            index = pd.Index(trainids, name='trainId')
-            data = ds[:]
-            if not index.is_unique:
-                pulse_id = self.file['/{}/pulseId'.format(data_src)]
-                pulse_id = pulse_id[:len(index), 0]
-                index = pd.MultiIndex.from_arrays([trainids, pulse_id],
-                                                  names=['trainId', 'pulseId'])
-                # Does pulse-oriented data always have an extra dimension?
-                assert data.shape[1] == 1
-                data = data[:, 0]
-            data = data[:len(index)]
-        else:
-            raise ValueError("Unknown data source %r" % data_src)
+        train_ids = None
+        if train_range is not None:
+            train_ids = _train_ids_for_range(train_range, self)
+        data_path, sel, trainids = self._field_selection(
+            device, key, train_ids, check_unique=False)
+        data = self.file[data_path][sel]
+        index = pd.Index(trainids, name='trainId')
+        if ':' in device and not index.is_unique:
+            pulse_id = self._pulse_ids_for_field(device, key, sel)
+            index = pd.MultiIndex.from_arrays([trainids, pulse_id],
+                                              names=['trainId', 'pulseId'])
+            # Does pulse-oriented data always have an extra dimension?
+            assert data.shape[1] == 1
+            data = data[:, 0]
 
         return pd.Series(data, name=name, index=index)
 
-    def get_dataframe(self, fields=(('*', '*'),), *, timestamps=False):
+    def get_dataframe(self, fields=(('*', '*'),), *, timestamps=False,
+                      train_range=None):
         """Return a pandas dataframe for given data fields.
 
         Parameters
@@ -640,21 +1764,25 @@ class H5File:
         timestamps : bool
             If false (the default), exclude the timestamps associated with each
             control data field.
+        train_range : by_id or by_index object, optional
+            Read only data for some trains, e.g. ``by_index[::10]`` for every
+            10th train, or ``by_id[10000:10100]``.
         """
         fields = _normalize_data_selection(fields, self)
         if not timestamps:
             fields = {(s, k) for (s, k) in fields if not k.endswith('.timestamp')}
-        control_series = [self.get_series(s, k) for (s, k) in fields]
 
-        if not control_series:
-            return None
-        return pd.concat(control_series, axis=1)
+        train_ids = None
+        if train_range is not None:
+            train_ids = _train_ids_for_range(train_range, self)
+        return _assemble_dataframe([self], fields, train_ids)
 
-    def get_array(self, device, key, extra_dims=None):
+    def get_array(self, device, key, extra_dims=None, roi=None,
+                  train_range=None, per_pulse=False):
         """Return a labelled array for a particular data field.
 
         The first axis of the returned data will be the train IDs.
-        Datasets which are per-pulse in the first dimension are not supported.
+        For data with more than one entry per train, use ``per_pulse=True``.
 
         Parameters
         ----------
@@ -669,38 +1797,86 @@ class H5File:
             Name extra dimensions in the array. The first dimension is
             automatically called 'train'. The default for extra dimensions
             is dim_0, dim_1, ...
+        roi: by_index object, optional
+            Read only a region of interest in the last dimensions of each
+            entry, e.g. ``by_index[100:200, 50:60]`` for a window of pixels.
+            Only this part of the data is read from the file.
+        train_range: by_id or by_index object, optional
+            Read only data for some trains, e.g. ``by_index[::10]`` for every
+            10th train, or ``by_id[10000:10100]``.
+        per_pulse: bool
+            If True, read pulse-resolved instrument data, with any number of
+            entries per train. The first dimension is then 'train_pulse',
+            labelled with a (trainId, pulseId) MultiIndex, so you can select
+            e.g. ``arr.sel(trainId=10005)`` or ``arr.unstack('train_pulse')``.
         """
         self._check_field(device, key)
-        name = self._make_field_name(device, key)
-
-        # Find the data
-        if ':' in device:  # INSTRUMENT data
-            keyhead, _, key = key.partition('.')
-            device += '/' + keyhead
-            data_src = 'INSTRUMENT/' + device
-        else:
-            data_src = 'CONTROL/' + device
-        data_path = "/{}/{}".format(data_src, key.replace('.', '/'))
+        train_ids = None
+        if train_range is not None:
+            train_ids = _train_ids_for_range(train_range, self)
+        data_path, sel, trainids = self._field_selection(
+            device, key, train_ids, check_unique=not per_pulse)
         ds = self.file[data_path]
+        data = ds[(sel,) + _checked_roi_index(roi, ds, key)]
 
-        # Get the index
-        if data_src.startswith('CONTROL'):
-            index_ds = self.index['trainId']
-            trainids = index_ds[index_ds[:] != 0]
-            data = ds[:len(trainids), ...]
-        elif data_src.startswith('INSTRUMENT'):
-            trainids = self._index_to_trainids(self.index[device])
-            data = ds[:len(trainids), ...]
-        else:
-            raise ValueError("Unknown data source %r" % data_src)
+        pulse_ids = None
+        if per_pulse:
+            pulse_ids = self._pulse_ids_for_field(device, key, sel)
+        return _labelled_array(data, trainids, extra_dims, pulse_ids)
+
+    def get_dask_array(self, device, key, extra_dims=None):
+        """Get a lazily loaded, labelled array for a particular data field.
+
+        This is like :meth:`get_array`, but the data is only read when you
+        compute something from it, in chunks, using `Dask
+        <https://docs.dask.org/en/latest/array.html>`_. So you can work with
+        data much bigger than memory, e.g. all frames of a detector module::
+
+            arr = f.get_dask_array('SPB_DET_AGIPD1M-1/DET/7CH0:xtdf', 'image.data')
+            mean_frame = arr.mean(axis=0).compute()
+
+        Per-pulse data is allowed: the trainId coordinate is repeated for each
+        entry in a train. This requires the dask package.
+
+        Parameters
+        ----------
+
+        device: str
+            Device name with optional output channel, e.g.
+            "SA1_XTD2_XGM/DOOCS/MAIN" or "SPB_DET_AGIPD1M-1/DET/7CH0:xtdf"
+        key: str
+            Key of parameter within that device, e.g. "image.data".
+        extra_dims: list of str
+            Name extra dimensions in the array. The first dimension is
+            called 'trainId'. The default for extra dimensions is
+            dim_0, dim_1, ...
+        """
+        import dask.array as da
+
+        self._check_field(device, key)
+        data_path, trainids = self._field_info(device, key, check_unique=False)
+
+        lazy_ds = _LazyDataset(self, data_path)
+        nrows = len(trainids)
+        # No dask lock: h5py serialises HDF5 calls itself, and _LazyDataset
+        # pins the file while reading, so the file pool can't close it.
+        data = da.from_array(lazy_ds, chunks=_dask_chunks(lazy_ds, nrows))[:nrows]
 
         if extra_dims is None:
             extra_dims = ['dim_%d' % i for i in range(data.ndim - 1)]
         dims = ['trainId'] + extra_dims
         return xr.DataArray(data, dims=dims, coords={'trainId': trainids})
 
+    def _close_handle(self):
+        """Close the underlying HDF5 file; it can be reopened as needed."""
+        self._read_plans.clear()  # Plans refer to datasets in the open file
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
     def close(self):
-        self.file.close()
+        self._pool.discard(self)
+        self._close_handle()
 
     # Context manager protocol - enables "with H5File(...):"
     def __enter__(self):
@@ -739,6 +1915,26 @@ class H5File:
         }
 
 
+def _read_file_info(path):
+    """Read metadata & index for one file, in the format of a run map entry.
+
+    This runs in a worker process when opening a run with several workers.
+    Returns None if *path* is not an HDF5 file.
+    """
+    if not h5py.is_hdf5(path):
+        return None
+    with H5File(path, pool=FilePool(1)) as f:
+        return {
+            'sources': f.sources,
+            'train_ids': f.index['trainId'][:],
+            'index': {h5_src: f._read_index(h5_src)
+                      for h5_src in (s.split('/', 1)[1] for s in f.sources)},
+            # Needed for the run map, so the main process doesn't walk the
+            # file again to find them.
+            'keys': {src: f._keys_for_source(src) for src in f.all_sources},
+        }
+
+
 class RunDirectory:
     """Access data from a 'run' generated at European XFEL.
 
@@ -750,38 +1946,155 @@ class RunDirectory:
     ----------
     path: str
         Path to the run directory.
+    use_run_map: bool
+        If True, use a cached 'run map' of the files' metadata, so that the
+        run can be opened without reading every file. The map is created or
+        updated if it is missing or out of date.
+    max_open_files: int, optional
+        The most files to keep open at once. Files are opened when data is
+        read from them, and the least recently used are closed to stay
+        within this limit. By default, a limit shared with other runs is used.
+    workers: int
+        Number of processes used to read the metadata & index of the files
+        in parallel when opening the run. The default (1) reads them serially.
+    train_cache_bytes: int, optional
+        If given, keep recently read trains from :meth:`train_from_id` and
+        :meth:`train_from_index` in memory, using up to this many bytes, so
+        reading the same trains again is fast. The cache is available as
+        ``run.train_cache`` (a :class:`TrainCache`), with hit & miss counts.
     """
-    def __init__(self, path):
-        self.files = [H5File(f) for f in glob(osp.join(path, '*.h5'))
-                      if h5py.is_hdf5(f)]
+    train_cache = None
 
-        self._trains = {}
-        for fhandler in self.files:
-            for train in fhandler.train_ids:
-                if train not in self._trains:
-                    self._trains[train] = []
-                self._trains[train].append(fhandler)
+    def __init__(self, path, *, use_run_map=False, max_open_files=None,
+                 workers=1, train_cache_bytes=None):
+        if max_open_files is None:
+            pool = default_file_pool
+        else:
+            pool = FilePool(max_open_files)
+        if train_cache_bytes is not None:
+            self.train_cache = TrainCache(train_cache_bytes)
+
+        self._set_files(self._open_files(
+            glob(osp.join(path, '*.h5')),
+            RunFilesMap(path) if use_run_map else None,
+            pool, workers
+        ))
 
-        self.ordered_trains = list(sorted(self._trains.items()))
-        self.train_indices = {tid: idx for idx, tid in enumerate(self.train_ids)}
+    @classmethod
+    def _from_files(cls, files):
+        """Make a RunDirectory from a list of H5File objects"""
+        self = cls.__new__(cls)
+        self._set_files(files)
+        return self
 
-    @property
-    def train_ids(self):
-        return [x[0] for x in self.ordered_trains]
+    def _set_files(self, files):
+        self.files = files
 
-    @property
-    def control_sources(self):
-        r = set()
+        # Sorted array of all train IDs in the run, and the first & last
+        # train ID in each file. Which files hold a given train is worked
+        # out from these when it is needed.
+        self._train_id_array = np.unique(np.concatenate(
+            [np.zeros(0, dtype=np.uint64)] +
+            [f._train_id_array for f in self.files]
+        ))
+        self._file_train_ranges = np.array([
+            (f._train_id_array.min(), f._train_id_array.max())
+            if len(f._train_id_array) else (1, 0)  # Empty range
+            for f in self.files
+        ], dtype=np.uint64).reshape(-1, 2)
+        self.train_ids = self._train_id_array.tolist()
+        self._train_indices = None
+
+        self.control_sources = set()
+        self.instrument_sources = set()
         for f in self.files:
-            r.update(f.control_sources)
-        return r
+            self.control_sources.update(f.control_sources)
+            self.instrument_sources.update(f.instrument_sources)
+        self._source_keys = {}
 
-    @property
-    def instrument_sources(self):
-        r = set()
+    def close(self):
+        """Close all the files in this run.
+
+        Files are also closed when the run object is no longer used, but
+        this releases them at a predictable time. They are reopened if
+        data is read again.
+        """
         for f in self.files:
-            r.update(f.instrument_sources)
-        return r
+            f.close()
+
+    # Context manager protocol - enables "with RunDirectory(...):"
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def train_indices(self):
+        """A dict mapping train IDs to their index in the run.
+
+        This is built the first time it is used; prefer
+        :meth:`train_from_id` in new code.
+        """
+        if self._train_indices is None:
+            self._train_indices = {tid: idx for idx, tid
+                                   in enumerate(self.train_ids)}
+        return self._train_indices
+
+    @property
+    def ordered_trains(self):
+        """A list of (train ID, [H5File]) tuples, sorted by train ID.
+
+        This is built each time it is accessed; prefer :attr:`train_ids` and
+        :meth:`train_from_id` in new code.
+        """
+        return [(tid, self._files_for_train(tid)) for tid in self.train_ids]
+
+    def _files_for_range(self, first_tid, last_tid):
+        """Get indices of the files whose trains overlap first_tid-last_tid
+
+        This only compares the first & last train ID of each file, so files
+        outside the range are never opened.
+        """
+        ranges = self._file_train_ranges
+        return ((ranges[:, 0] <= last_tid) &
+                (ranges[:, 1] >= first_tid)).nonzero()[0]
+
+    def _files_for_train(self, train_id):
+        """Get the list of files with data for this train"""
+        return [self.files[i] for i in self._files_for_range(train_id, train_id)
+                if train_id in self.files[i].train_indices]
+
+    def _has_train(self, train_id):
+        ix = np.searchsorted(self._train_id_array, train_id)
+        return (ix < len(self._train_id_array)
+                and self._train_id_array[ix] == train_id)
+
+    @staticmethod
+    def _open_files(paths, run_map=None, pool=None, workers=1):
+        cache_infos = {}
+        if run_map:
+            for path in paths:
+                cache_infos[path] = run_map.get(path)
+        to_read = [p for p in paths if not cache_infos.get(p)]
+
+        if workers > 1 and len(to_read) > 1:
+            # h5py serialises HDF5 calls within a process, so read the
+            # metadata in separate processes and only use it here.
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                cache_infos.update(zip(to_read,
+                                       executor.map(_read_file_info, to_read)))
+            paths = [p for p in paths if cache_infos[p]]
+        else:
+            paths = [p for p in paths
+                     if cache_infos.get(p) or h5py.is_hdf5(p)]
+
+        files = [H5File(p, pool=pool, _cache_info=cache_infos.get(p))
+                 for p in paths]
+
+        if run_map and to_read:
+            run_map.save(files)
+        return files
 
     @property
     def all_sources(self):
@@ -794,21 +2107,23 @@ class RunDirectory:
             raise PropertyNameError(key, source)
 
     def _keys_for_source(self, source):
+        try:
+            return self._source_keys[source]
+        except KeyError:
+            pass
+
         # The same source may be in multiple files, but this assumes it has
         # the same keys in all files that it appears in.
         for f in self.files:
-            if source in (f.control_sources | f.instrument_sources):
-                return f._keys_for_source(source)
+            if source in f.all_sources:
+                res = self._source_keys[source] = f._keys_for_source(source)
+                return res
 
         raise ValueError("No keys found for source {}".format(source))
 
-    def _check_data_missing(self, selection, tid, fhs):
-        missing = selection.copy()
-        for file in fhs:
-            missing = file._check_data_missing(missing, tid)
-        return missing
-
-    def trains(self, devices=None, train_range=None, *, require_all=False):
+    def trains(self, devices=None, train_range=None, *, require_all=False,
+               prefetch=0, processes=0, pulses=None, roi=None,
+               preload_control=False):
         """Iterate over all trains in the run and gather all sources.
 
         ::
@@ -829,11 +2144,46 @@ class RunDirectory:
 
                 f.trains(train_range=by_index[20:])
 
+            This can also be a list or array of train IDs or indices, e.g.
+            ``by_id[tids]``, to read only those trains.
+
         require_all: bool
             False (default) returns any data available for the requested trains.
             True skips trains which don't have all the requested data;
             this requires that you specify required data using *devices*.
 
+        prefetch: int
+            If this is more than 0, read up to this many trains ahead in a
+            background thread, so reading data overlaps with your processing::
+
+                for tid, data in run.trains(prefetch=2):
+                    ...
+
+            Don't read other data from the same run while iterating like this.
+
+        processes: int
+            If this is more than 0, read trains in this many worker processes.
+            Each worker opens the files itself, so this can read data faster
+            than one process can. Trains are still yielded in order.
+            Large arrays are passed back through shared memory where possible.
+
+        pulses: by_index, by_id or by_cell object, optional
+            Read only some frames of detector data in each train, selected
+            by position in the train, by pulse ID or by memory cell ID.
+            Refer to :meth:`H5File.trains` for details.
+
+        roi: by_index object, optional
+            Read only a region of interest in the last dimensions of images,
+            e.g. ``by_index[100:200, 50:60]``.
+            Refer to :meth:`H5File.trains` for details.
+
+        preload_control: bool or int
+            If True, read the selected control data from each file into
+            memory when it's first needed, rather than reading each train's
+            values separately. A number sets the memory limit per file in
+            bytes. Refer to :meth:`H5File.trains` for details.
+            This can't be combined with *processes*.
+
         Yields
         ------
 
@@ -842,35 +2192,292 @@ class RunDirectory:
         data : dict
             The data for this train, keyed by device name
         """
-        if isinstance(train_range, by_id):
-            start_ix = _tid_to_slice_ix(train_range.value.start, self, stop=False)
-            stop_ix = _tid_to_slice_ix(train_range.value.stop, self, stop=True)
-            ix_slice = slice(start_ix, stop_ix, train_range.value.step)
-        elif isinstance(train_range, by_index):
-            ix_slice = train_range.value
-        elif train_range is None:
-            ix_slice = slice(None, None)
-        else:
-            raise TypeError(train_range)
+        if prefetch:
+            yield from _prefetch(self.trains(devices, train_range,
+                                             require_all=require_all,
+                                             processes=processes,
+                                             pulses=pulses, roi=roi,
+                                             preload_control=preload_control),
+                                 prefetch)
+            return
+
+        train_ix = _train_range_to_index(train_range, self)
 
         if devices:
             devices = _normalize_data_selection(devices, self)
         elif require_all:
             raise ValueError("Cannot skip partial data without devices= parameter")
 
-        for tid, fhs in self.ordered_trains[ix_slice]:
-            if require_all and self._check_data_missing(devices, tid, fhs):
-                continue
-
+        train_ids = self._train_id_array[train_ix]
+        if require_all:
+            mask = _complete_trains_mask(self.files, self._train_id_array,
+                                         devices, self)
+            train_ids = train_ids[mask[train_ix]]
+        train_ids = train_ids.tolist()
+
+        if processes:
+            if preload_control:
+                raise ValueError("preload_control can't be used with processes")
+            from .multiprocess import iterate_trains_mp
+            yield from iterate_trains_mp(self, train_ids, devices, processes,
+                                         pulses, roi)
+            return
+
+        yield from self._iter_train_ids(train_ids, devices, pulses, roi,
+                                        preload_control)
+
+    def _iter_train_ids(self, train_ids, devices=None, pulses=None, roi=None,
+                        preload_control=False):
+        """Iterate over the given train IDs, which must be in the run.
+
+        devices must already be normalised, if it is given.
+        With preload_control, train_ids must be in increasing order; each
+        file's control data is dropped once we're past its last train.
+        """
+        preload_bytes = _preload_max_bytes(preload_control)
+        if not train_ids:
+            return
+
+        # Find the files we need once, skipping those outside the range of
+        # trains and those without any of the selected data.
+        files, file_selections = [], []
+        for i in self._files_for_range(min(train_ids), max(train_ids)):
+            selection = self.files[i]._filter_selection(devices)
+            if selection is None or selection:
+                files.append(self.files[i])
+                file_selections.append(selection)
+        ranges = np.array([(f._train_id_array.min(), f._train_id_array.max())
+                           for f in files], dtype=np.uint64).reshape(-1, 2)
+
+        preloaded = {}  # File number -> preloaded control data
+
+        for tid in train_ids:
+            candidates = ((ranges[:, 0] <= tid) & (ranges[:, 1] >= tid)).nonzero()[0]
+            if preload_bytes:
+                for i in [i for i in preloaded if ranges[i, 1] < tid]:
+                    del preloaded[i]
             train_data = {}
-            for fh in fhs:
-                file_selection = fh._filter_selection(devices)
-                _, data = fh.train_from_id(tid, devices=file_selection)
+            for i in candidates:
+                fh = files[i]
+                try:
+                    index = fh.train_indices[tid]
+                except KeyError:
+                    continue
+                if preload_bytes and i not in preloaded:
+                    preloaded[i] = fh._preload_control(file_selections[i],
+                                                       preload_bytes)
+                _, data = fh._gen_train_data(index, only_this=file_selections[i],
+                                             pulses=pulses, roi=roi,
+                                             preloaded=preloaded.get(i))
                 train_data.update(data)
 
             yield (tid, train_data)
 
-    def train_from_id(self, train_id, devices=None):
+    def train_batches(self, batch_size, devices=None, train_range=None):
+        """Iterate over the run in batches of several trains.
+
+        This reads each dataset once per batch, rather than once per train,
+        which is much faster for small pieces of data, like control data::
+
+            for batch in run.train_batches(100, [('*_XGM/*', '*.i[xy]Pos')]):
+                ixpos = batch.data['SA1_XTD2_XGM/DOOCS/MAIN']['beamPosition.ixPos.value']
+
+        Parameters
+        ----------
+        batch_size: int
+            The number of trains in each batch. The last batch may be smaller.
+        devices: dict or list, optional
+            Filter data by devices and by parameters.
+
+            Refer to :meth:`H5File.trains` for how to use this.
+        train_range: by_id or by_index object, optional
+            Iterate over only selected trains, by train ID or by index.
+
+        Yields
+        ------
+
+        batch : TrainBatch
+            The data for up to *batch_size* trains.
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        train_ix = _train_range_to_index(train_range, self)
+        if devices:
+            devices = _normalize_data_selection(devices, self)
+
+        train_ids = self._train_id_array[train_ix]
+        for start in range(0, len(train_ids), batch_size):
+            yield self._read_batch(train_ids[start:start + batch_size], devices)
+
+    def train_ids_where(self, conditions):
+        """Find the trains where some data meets all the given conditions.
+
+        Conditions are checked on whole arrays of data read in bulk, like
+        :meth:`get_array`, before reading anything else. Pass the result to
+        :meth:`trains` to read other data, e.g. from a detector, only for
+        the matching trains::
+
+            hits = run.train_ids_where({
+                ('SA1_XTD2_XGM/DOOCS/MAIN', 'pulseEnergy.photonFlux.value'):
+                    (1000, None),
+                ('SPB_IRU_MOTORS/MDL/SAMPLE_X', 'actualPosition.value'):
+                    lambda x: abs(x - 2.5) < 0.1,
+            })
+            for tid, data in run.trains(devices=[('*/DET/*', 'image.data')],
+                                        train_range=by_id[hits]):
+                ...
+
+        Parameters
+        ----------
+        conditions: dict
+            Maps (source, key) pairs to conditions on their data. A condition
+            can be a ``(low, high)`` tuple for an inclusive range of values,
+            with None for no limit. Or it can be a function taking an array
+            with the data for many trains, and returning a boolean array with
+            one value per train. The data must have at most one entry per
+            train; trains without data for a field don't match.
+
+        Returns
+        -------
+        numpy.ndarray
+            The sorted train IDs where all the conditions are true.
+        """
+        train_ids = self._train_id_array
+        for (source, key), condition in conditions.items():
+            if len(train_ids) == 0:
+                break
+            self._check_field(source, key)
+            # Only read data for trains which matched the conditions so far
+            train_range = None if train_ids is self._train_id_array \
+                else by_id[train_ids]
+            data, field_tids, _ = self._read_field(source, key,
+                                                   train_range=train_range)
+
+            if callable(condition):
+                mask = np.asarray(condition(data), dtype=bool)
+                if mask.shape != field_tids.shape:
+                    raise ValueError(
+                        "Condition for {}/{} gave shape {}, expected {}".format(
+                            source, key, mask.shape, field_tids.shape))
+            else:
+                low, high = condition
+                mask = np.ones(data.shape, dtype=bool)
+                if low is not None:
+                    mask &= data >= low
+                if high is not None:
+                    mask &= data <= high
+                if mask.ndim > 1:
+                    raise ValueError("{}/{} has more than one value per train; "
+                                     "use a function as the condition"
+                                     .format(source, key))
+
+            train_ids = np.intersect1d(train_ids, field_tids[mask])
+        return train_ids
+
+    def batch_from_ids(self, train_ids, devices=None):
+        """Read any set of trains together, as a :class:`TrainBatch`.
+
+        Use this to get scattered trains, such as those picked out by a
+        threshold on some other data::
+
+            hits = xgm_intensity.trainId[xgm_intensity > 1000]
+            batch = run.batch_from_ids(hits, [('*/DET/*', 'image.data')])
+
+        The trains are grouped by file and read in order of train ID, so
+        each dataset is read with as few HDF5 selections as possible. The
+        batch has the trains in the order given.
+
+        Parameters
+        ----------
+        train_ids: array or list of int
+            The train IDs to read. These can be in any order.
+        devices: dict or list, optional
+            Filter data by devices and by parameters.
+
+            Refer to :meth:`H5File.trains` for how to use this.
+
+        Raises
+        ------
+        KeyError
+            if any of the train IDs are not in the run.
+        """
+        if devices:
+            devices = _normalize_data_selection(devices, self)
+
+        def read_batch(unique_ids):
+            missing = ~np.isin(unique_ids, self._train_id_array)
+            if missing.any():
+                raise KeyError("trains {} not found in run".format(
+                    unique_ids[missing].tolist()))
+            return self._read_batch(unique_ids, devices)
+
+        return _batch_in_order(train_ids, read_batch)
+
+    def _read_batch(self, train_ids, devices=None):
+        """Read data for a sorted array of train IDs into a TrainBatch"""
+        parts = defaultdict(list)  # (source, key) -> [(positions, data, counts)]
+        # source -> trains already read for it; if a train is in several
+        # files for one source, use the first.
+        done = defaultdict(lambda: np.zeros(len(train_ids), dtype=bool))
+        for i in self._files_for_range(train_ids.min(), train_ids.max()):
+            f = self.files[i]
+            file_selection = f._filter_selection(devices)
+            if file_selection is not None and not file_selection:
+                continue
+
+            # Find which of these trains are in this file
+            file_tids = f._train_id_array
+            file_ixs = np.searchsorted(file_tids, train_ids)
+            present = file_tids[np.minimum(file_ixs, len(file_tids) - 1)] == train_ids
+            if not present.any():
+                continue
+
+            # Group the sources by which trains they still need from this file
+            if file_selection is None:
+                sources = f.all_sources
+            else:
+                sources = {src for (src, _) in file_selection}
+            by_needed = defaultdict(set)
+            for source in sources:
+                needed = present & ~done[source]
+                done[source] |= present
+                if needed.any():
+                    by_needed[needed.tobytes()].add(source)
+
+            for needed_bytes, needed_sources in by_needed.items():
+                needed = np.frombuffer(needed_bytes, dtype=bool)
+                selection = file_selection
+                if len(needed_sources) < len(sources):
+                    if selection is None:
+                        selection = {(src, key) for (src, key, *_)
+                                     in f._dataset_catalog()}
+                    selection = {(src, key) for (src, key) in selection
+                                 if src in needed_sources}
+
+                batch_positions = needed.nonzero()[0]
+                file_data = f._read_trains(file_ixs[needed], selection)
+                for source, src_data in file_data.items():
+                    for key, (data, counts) in src_data.items():
+                        parts[source, key].append((batch_positions, data, counts))
+
+        batch_data, batch_counts = defaultdict(dict), defaultdict(dict)
+        for (source, key), pieces in parts.items():
+            # Sequence files for one source hold consecutive blocks of trains
+            pieces.sort(key=lambda p: p[0][0])
+            counts = np.zeros(len(train_ids), dtype=np.int64)
+            for positions, _, piece_counts in pieces:
+                counts[positions] = piece_counts
+            if len(pieces) == 1:
+                data = pieces[0][1]
+            else:
+                data = np.concatenate([p[1] for p in pieces])
+
+            batch_data[source][key] = data
+            batch_counts[source][key] = counts
+
+        return TrainBatch(train_ids, dict(batch_data), dict(batch_counts))
+
+    def train_from_id(self, train_id, devices=None, *, pulses=None, roi=None):
         """Get Train data for specified train ID.
 
         Parameters
@@ -881,6 +2488,10 @@ class RunDirectory:
             Filter data by devices and by parameters.
 
             Refer to :meth:`H5File.trains` for how to use this.
+        pulses: by_index, by_id or by_cell object, optional
+            Read only some detector frames; see :meth:`H5File.trains`.
+        roi: by_index object, optional
+            Read only a region of interest in images; see :meth:`H5File.trains`.
 
         Returns
         -------
@@ -888,17 +2499,27 @@ class RunDirectory:
         tid : int
             The train ID of the returned train
         data : dict
-            The data for this train, keyed by device name
+            The data for this train, keyed by device name.
+            If the run has a train cache, arrays may be shared with the
+            cache, so don't modify them.
 
         Raises
         ------
         KeyError
             if `train_id` is not found in the run.
         """
-        try:
-            files = self._trains[train_id]
-        except KeyError:
+        # Trains with pulses or roi selections are not cached
+        cache_key = None
+        if self.train_cache is not None and pulses is None and roi is None:
+            cache_key = (int(train_id), _selection_key(devices))
+            data = self.train_cache.get(cache_key)
+            if data is not None:
+                # New dicts, so changing them doesn't affect the cache
+                return train_id, {src: dict(d) for (src, d) in data.items()}
+
+        if not self._has_train(train_id):
             raise KeyError("train {} not found in run.".format(train_id))
+        files = self._files_for_train(train_id)
 
         if devices is not None:
             devices = _normalize_data_selection(devices, self)
@@ -906,11 +2527,16 @@ class RunDirectory:
         data = {}
         for fh in files:
             file_selection = fh._filter_selection(devices)
-            _, d = fh.train_from_id(train_id, devices=file_selection)
+            _, d = fh.train_from_id(train_id, devices=file_selection,
+                                    pulses=pulses, roi=roi)
             data.update(d)
+
+        if cache_key is not None:
+            self.train_cache.put(cache_key, data)
+            data = {src: dict(d) for (src, d) in data.items()}
         return (train_id, data)
 
-    def train_from_index(self, index, devices=None):
+    def train_from_index(self, index, devices=None, *, pulses=None, roi=None):
         """Get the nth train in the run.
 
         Parameters
@@ -921,6 +2547,10 @@ class RunDirectory:
             Filter data by devices and by parameters.
 
             Refer to :meth:`H5File.trains` for how to use this.
+        pulses: by_index, by_id or by_cell object, optional
+            Read only some detector frames; see :meth:`H5File.trains`.
+        roi: by_index object, optional
+            Read only a region of interest in images; see :meth:`H5File.trains`.
 
         Returns
         -------
@@ -936,21 +2566,38 @@ class RunDirectory:
             if train `index` is out of range.
         """
         try:
-            train_id, files = self.ordered_trains[index]
+            train_id = self.train_ids[index]
         except IndexError:
             raise IndexError("Train index {} out of range.".format(index))
+        return self.train_from_id(train_id, devices, pulses=pulses, roi=roi)
+
+    def data_counts(self, devices=None):
+        """Count the data recorded for each train & source.
+
+        This only reads the INDEX sections of the files, not the data::
 
+            counts = run.data_counts([('*_XGM/*', '*')])
+            usable = counts.index[(counts > 0).all(axis=1)]
+
+        Parameters
+        ----------
+        devices: dict or list, optional
+            Only count data for these devices and parameters.
+            Refer to :meth:`H5File.trains` for how to use this.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Indexed by train ID, with a column for each control source, and
+            one for each group of keys of an instrument source, e.g.
+            ``"FXE_DET_LPD1M-1/DET/0CH0:xtdf/image"``, which are recorded
+            separately.
+        """
         if devices is not None:
             devices = _normalize_data_selection(devices, self)
+        return _data_counts_frame(self.files, self._train_id_array, devices)
 
-        data = {}
-        for fh in files:
-            file_selection = fh._filter_selection(devices)
-            _, d = fh.train_from_id(train_id, devices=file_selection)
-            data.update(d)
-        return (train_id, data)
-
-    def get_series(self, device, key):
+    def get_series(self, device, key, train_range=None):
         """Return a pandas Series for a particular data field.
 
         Parameters
@@ -962,14 +2609,90 @@ class RunDirectory:
         key: str
             Key of parameter within that device, e.g. "beamPosition.iyPos.value"
             or "header.linkId". The data must be 1D in the file.
+        train_range: by_id or by_index object, optional
+            Read only data for some trains, e.g. ``by_index[::10]`` for every
+            10th train, or ``by_id[10000:10100]``. Files with none of these
+            trains are skipped.
         """
         self._check_field(device, key)
-        seq_series = [f.get_series(device, key) for f in self.files
-                      if device in (f.control_sources | f.instrument_sources)]
+        name = H5File._make_field_name(device, key)
+        data, trainids, parts = self._read_field(
+            device, key, check_unique=False, train_range=train_range)
+
+        index = pd.Index(trainids, name='trainId')
+        if ':' in device and not index.is_unique:
+            pulse_id = np.concatenate([
+                f._pulse_ids_for_field(device, key, sel)
+                for (f, sel) in parts
+            ])
+            index = pd.MultiIndex.from_arrays([trainids, pulse_id],
+                                              names=['trainId', 'pulseId'])
+            # Does pulse-oriented data always have an extra dimension?
+            assert data.shape[1] == 1
+            data = data[:, 0]
+
+        return pd.Series(data, name=name, index=index)
 
-        return pd.concat(sorted(seq_series, key=lambda s: s.index[0]))
+    def _read_field(self, device, key, check_unique=True, roi=None,
+                    train_range=None):
+        """Read one field from all files into a single array.
 
-    def get_dataframe(self, fields=(('*', '*'),), *, timestamps=False):
+        The size of the result is found from the index first, and each file's
+        data is read straight into its place, so there's no concatenation.
+        Returns (data, train IDs, [(H5File, selection)]), with files in
+        order of train ID.
+        """
+        train_ids = None
+        files = [f for f in self.files if device in f.all_sources]
+        if not files:
+            raise SourceNameError(device)
+        if train_range is not None:
+            # The IDs are descending for a negative step, e.g. by_index[::-10]
+            train_ids = _train_ids_for_range(train_range, self)
+            in_range = set()
+            if len(train_ids):
+                in_range = set(self._files_for_range(train_ids.min(),
+                                                     train_ids.max()))
+            in_range_files = [f for (i, f) in enumerate(self.files)
+                              if i in in_range and device in f.all_sources]
+            if in_range_files:
+                files = in_range_files
+            else:
+                # No data in these trains; one file still gives the shape
+                files = files[:1]
+
+        parts = []
+        for f in files:
+            path, sel, tids = f._field_selection(device, key, train_ids,
+                                                 check_unique)
+            parts.append((f, path, sel, tids))
+
+        non_empty = [p for p in parts if len(p[3])]
+        non_empty.sort(key=lambda p: p[3][0])
+        # Keep one file to get the shape from, if they're all empty
+        parts = non_empty or parts[:1]
+
+        f0, path0, _, _ = parts[0]
+        ds = f0.file[path0]
+        roi_ix = _checked_roi_index(roi, ds, key)
+        # The shape of an entry after the ROI, without allocating anything
+        entry_shape = np.broadcast_to(0, ds.shape[1:])[roi_ix].shape
+        dtype = np.result_type(*[f.file[path].dtype for (f, path, _, _) in parts])
+
+        trainids = np.concatenate([tids for (_, _, _, tids) in parts])
+        data = np.empty((len(trainids),) + entry_shape, dtype=dtype)
+        start = 0
+        for f, path, sel, tids in parts:
+            n = len(tids)
+            if n:
+                f.file[path].read_direct(data, (sel,) + roi_ix,
+                                         np.s_[start:start + n])
+            start += n
+
+        return data, trainids, [(f, sel) for (f, _, sel, _) in parts]
+
+    def get_dataframe(self, fields=(('*', '*'),), *, timestamps=False,
+                      train_range=None):
         """Return a pandas Dataframe for the 1D, train-oriented data in this run
 
         Parameters
@@ -981,30 +2704,31 @@ class RunDirectory:
         timestamps : bool
             If false (the default), exclude the timestamps associated with each
             control data field.
+        train_range : by_id or by_index object, optional
+            Read only data for some trains, e.g. ``by_index[::10]`` for every
+            10th train, or ``by_id[10000:10100]``. Files with none of these
+            trains are skipped.
         """
         fields = _normalize_data_selection(fields, self)
         if not timestamps:
             fields = {(s, k) for (s, k) in fields if not k.endswith('.timestamp')}
 
-        group_dfs = []
-        for _, files in self._assemble_sequences().items():
-            file_dfs = []
-            for f in files:
-                file_selection = f._filter_selection(fields)
-                if file_selection:
-                    # .timestamp fields were already filtered out above, so
-                    # the file code can skip filtering them.
-                    df = f.get_dataframe(fields=file_selection, timestamps=True)
-                    file_dfs.append(df)
-            if file_dfs:
-                group_dfs.append(pd.concat(file_dfs))
-        return pd.concat(group_dfs, axis=1)
-
-    def get_array(self, device, key, extra_dims=None):
+        files, train_ids = self.files, None
+        if train_range is not None:
+            train_ids = _train_ids_for_range(train_range, self)
+            files = []
+            if len(train_ids):
+                files = [self.files[i] for i in
+                         self._files_for_range(train_ids.min(), train_ids.max())]
+
+        return _assemble_dataframe(files, fields, train_ids)
+
+    def get_array(self, device, key, extra_dims=None, roi=None,
+                  train_range=None, per_pulse=False):
         """Return a labelled array for a particular data field.
 
         The first axis of the returned data will be the train IDs.
-        Datasets which are per-pulse in the first dimension are not supported.
+        For data with more than one entry per train, use ``per_pulse=True``.
 
         Parameters
         ----------
@@ -1019,39 +2743,72 @@ class RunDirectory:
             Name extra dimensions in the array. The first dimension is
             automatically called 'train'. The default for extra dimensions
             is dim_0, dim_1, ...
+        roi: by_index object, optional
+            Read only a region of interest in the last dimensions of each
+            entry, e.g. ``by_index[100:200, 50:60]`` for a window of pixels.
+            Only this part of the data is read from the file.
+        train_range: by_id or by_index object, optional
+            Read only data for some trains, e.g. ``by_index[::10]`` for every
+            10th train, or ``by_id[10000:10100]``. Files with none of these
+            trains are skipped.
+        per_pulse: bool
+            If True, read pulse-resolved instrument data, with any number of
+            entries per train. The first dimension is then 'train_pulse',
+            labelled with a (trainId, pulseId) MultiIndex, so you can select
+            e.g. ``arr.sel(trainId=10005)`` or ``arr.unstack('train_pulse')``.
+        """
+        self._check_field(device, key)
+        data, trainids, parts = self._read_field(
+            device, key, check_unique=not per_pulse, roi=roi,
+            train_range=train_range)
+
+        pulse_ids = None
+        if per_pulse:
+            pulse_ids = np.concatenate([
+                f._pulse_ids_for_field(device, key, sel) for (f, sel) in parts
+            ])
+        return _labelled_array(data, trainids, extra_dims, pulse_ids)
+
+    def get_dask_array(self, device, key, extra_dims=None):
+        """Get a lazily loaded, labelled array for a particular data field.
+
+        This is like :meth:`get_array`, but the data is only read when you
+        compute something from it, using `Dask
+        <https://docs.dask.org/en/latest/array.html>`_. Chunks never span
+        more than one file, so they can be read in parallel::
+
+            arr = run.get_dask_array('SPB_DET_AGIPD1M-1/DET/7CH0:xtdf', 'image.data')
+            mean_frame = arr.mean(axis=0).compute()
+
+        Per-pulse data is allowed: the trainId coordinate is repeated for each
+        entry in a train. This requires the dask package.
+
+        Parameters
+        ----------
+
+        device: str
+            Device name with optional output channel, e.g.
+            "SA1_XTD2_XGM/DOOCS/MAIN" or "SPB_DET_AGIPD1M-1/DET/7CH0:xtdf"
+        key: str
+            Key of parameter within that device, e.g. "image.data".
+        extra_dims: list of str
+            Name extra dimensions in the array. The first dimension is
+            called 'trainId'. The default for extra dimensions is
+            dim_0, dim_1, ...
         """
         self._check_field(device, key)
-        seq_arrays = [f.get_array(device, key, extra_dims=extra_dims)
+        seq_arrays = [f.get_dask_array(device, key, extra_dims=extra_dims)
                       for f in self.files
                       if device in (f.control_sources | f.instrument_sources)]
 
         non_empty = [a for a in seq_arrays if (a.size > 0)]
         if not non_empty:
-            if seq_arrays:
-                # All per-file arrays are empty, so just return the first one.
-                return seq_arrays[0]
-
-            raise Exception(("Unable to get data for source {!r}, key {!r}. "
-                             "Please report an issue so we can investigate")
-                            .format(device, key))
+            return seq_arrays[0]
 
+        # Concatenating dask arrays is lazy, so this doesn't read anything.
         return xr.concat(sorted(non_empty, key=lambda a: a.coords['trainId'][0]),
                          dim='trainId')
 
-    def _assemble_sequences(self):
-        """Assemble the sequences for each data recorder.
-
-        Returns a dict keyed by filename prefix, with ordered lists of the
-        H5File objects (...-S00000.h5, ...-S00001.h5, etc.)
-        """
-        segment_sequences = defaultdict(list)
-        for f in sorted(self.files, key=lambda f: osp.basename(f.file.filename)):
-            m = re.match(r'(.+)-S\d+\.h5', osp.basename(f.file.filename))
-            if not m:
-                raise ValueError("Unrecognised filename: %s" % f.file.filename)
-            segment_sequences[m.group(1)].append(f)
-        return dict(segment_sequences)
-
     def _get_sources(self, src):
         """Return sets of control and instrument source names.
         control: train data
@@ -1067,9 +2824,9 @@ class RunDirectory:
         """Show information about the run.
         """
         # time info
-        first_train, _ = self.ordered_trains[0]
-        last_train, _ = self.ordered_trains[-1]
-        train_count = len(self.ordered_trains)
+        first_train = self.train_ids[0]
+        last_train = self.train_ids[-1]
+        train_count = len(self.train_ids)
         span_sec = (last_train - first_train) / 10
         span_txt = str(datetime.timedelta(seconds=span_sec))
 
@@ -1135,11 +2892,9 @@ class RunDirectory:
         ValueError
             if `train_id` is not found in the run.
         """
-        tid, files = next((t for t in self.ordered_trains
-                          if t[0] == train_id), (None, None))
-        if tid is None:
+        if not self._has_train(train_id):
             raise ValueError("train {} not found in run.".format(train_id))
-        ctrl, inst = self._get_sources(files)
+        ctrl, inst = self._get_sources(self._files_for_train(train_id))
 
         # disp
         print('Train [{}] information'.format(train_id))
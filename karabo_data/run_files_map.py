@@ -0,0 +1,185 @@
+# coding: utf-8
+"""Cache metadata about the files in a run directory.
+
+Opening a run means reading METADATA and INDEX from every HDF5 file in it,
+which is slow on parallel filesystems with hundreds of sequence files.
+The run map stores what we need to know about each file - train IDs, sources,
+keys and index arrays - in a single sidecar file, so a run can be reopened
+without touching the data files until data is actually read.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+import json
+import numpy as np
+import os
+import os.path as osp
+import tempfile
+
+FORMAT_VERSION = 1
+
+MAP_FILENAME = 'karabo_data_map.npz'
+
+
+def _user_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or osp.expanduser('~/.cache')
+    return osp.join(cache_home, 'karabo_data')
+
+
+class RunFilesMap:
+    """Cached information about the files in a run directory.
+
+    Entries are keyed on the file name, and are only used if the size and
+    modification time of the file still match the cached values.
+
+    The map is looked for in the run directory itself, then in a per-user
+    cache directory (``~/.cache/karabo_data``). It is saved to the first of
+    those locations which is writable.
+    """
+    def __init__(self, directory):
+        self.directory = osp.abspath(directory)
+        self.candidate_paths = self.map_paths_for_run(self.directory)
+        self.files_data = {}
+        self.loaded_from = None
+        self.load()
+
+    @staticmethod
+    def map_paths_for_run(directory):
+        # e.g. /gpfs/exfel/exp/SPB/201830/p900022/raw/r0034 ->
+        #      ~/.cache/karabo_data/gpfs_exfel_exp_..._r0034.npz
+        munged = osp.realpath(directory).strip(os.sep).replace(os.sep, '_')
+        return [
+            osp.join(directory, MAP_FILENAME),
+            osp.join(_user_cache_dir(), munged + '.npz'),
+        ]
+
+    def load(self):
+        """Load the cached data, if any, from the first readable location."""
+        for path in self.candidate_paths:
+            try:
+                with np.load(path) as npz:
+                    meta = json.loads(str(npz['meta']))
+                    if meta.get('format_version') != FORMAT_VERSION:
+                        continue
+                    arrays = {k: npz[k] for k in npz.files if k != 'meta'}
+
+                files_data = {}
+                for i, info in enumerate(meta['files']):
+                    files_data[info['filename']] = self._unpack(i, info, arrays)
+            except Exception:
+                # A corrupt or inconsistent map is treated as missing; it's
+                # only a cache, so it mustn't stop the run being opened.
+                continue
+
+            self.files_data = files_data
+            self.loaded_from = path
+            return
+
+    @staticmethod
+    def _unpack(i, info, arrays):
+        first_all = arrays['first_%d' % i]
+        count_all = arrays['count_%d' % i]
+        index = {}
+        start = 0
+        for h5_source, n in zip(info['index_groups'], info['index_lengths']):
+            index[h5_source] = (first_all[start:start + n],
+                                count_all[start:start + n])
+            start += n
+
+        return {
+            'mtime': info['mtime'],
+            'size': info['size'],
+            'train_ids': arrays['train_ids_%d' % i],
+            'sources': info['sources'],
+            'keys': {src: set(keys) for (src, keys) in info['keys'].items()},
+            'index': index,
+        }
+
+    def get(self, path):
+        """Get cached information for one file.
+
+        Returns None if the file is not in the map, or if it has changed
+        since the map was saved.
+        """
+        try:
+            info = self.files_data[osp.basename(path)]
+            st = os.stat(path)
+        except (KeyError, OSError):
+            return None
+
+        if (st.st_mtime, st.st_size) != (info['mtime'], info['size']):
+            return None
+        return info
+
+    def save(self, files):
+        """Save information about the given H5File objects.
+
+        Files whose information was already loaded from the map are not
+        reopened. This silently does nothing if no location is writable.
+        """
+        meta_files = []
+        arrays = {}
+        for i, f in enumerate(sorted(files, key=lambda f: f.path)):
+            info = self.get(f.path)
+            if info is None:
+                info = self._collect_file_info(f)
+
+            index_groups = sorted(info['index'])
+            meta_files.append({
+                'filename': osp.basename(f.path),
+                'mtime': info['mtime'],
+                'size': info['size'],
+                'sources': info['sources'],
+                'keys': {src: sorted(keys) for (src, keys) in info['keys'].items()},
+                'index_groups': index_groups,
+                'index_lengths': [len(info['index'][g][0]) for g in index_groups],
+            })
+            arrays['train_ids_%d' % i] = np.asarray(info['train_ids'], dtype=np.uint64)
+            arrays['first_%d' % i] = np.concatenate(
+                [np.zeros(0, np.uint64)] +
+                [info['index'][g][0].astype(np.uint64) for g in index_groups])
+            arrays['count_%d' % i] = np.concatenate(
+                [np.zeros(0, np.uint64)] +
+                [info['index'][g][1].astype(np.uint64) for g in index_groups])
+
+        meta = json.dumps({'format_version': FORMAT_VERSION, 'files': meta_files})
+
+        for path in self.candidate_paths:
+            try:
+                os.makedirs(osp.dirname(path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=osp.dirname(path),
+                                                suffix='.npz.tmp')
+            except OSError:
+                continue
+
+            try:
+                with os.fdopen(fd, 'wb') as tmp:
+                    np.savez_compressed(tmp, meta=np.array(meta), **arrays)
+                os.replace(tmp_path, path)
+            except OSError:
+                os.unlink(tmp_path)
+                continue
+            return path
+
+    @staticmethod
+    def _collect_file_info(f):
+        """Read everything we cache about one file, opening it if necessary."""
+        st = os.stat(f.path)
+        keys = {src: f._keys_for_source(src) for src in f.all_sources}
+        index = {}
+        for source in f.sources:
+            h5_source = source.split('/', 1)[1]
+            index[h5_source] = f._read_index(h5_source)
+
+        return {
+            'mtime': st.st_mtime,
+            'size': st.st_size,
+            'train_ids': f._index_train_ids,
+            'sources': f.sources,
+            'keys': keys,
+            'index': index,
+        }
@@ -0,0 +1,93 @@
+from itertools import islice
+import numpy as np
+import os
+import pytest
+from tempfile import TemporaryDirectory
+
+from karabo_data import (
+    RunDirectory, LPD1M, AGIPD1M, SourceNameError, by_index,
+)
+from . import make_examples
+
+
+def test_lpd_trains_into_buffer(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    det = LPD1M(run)
+    assert len(det.modules) == 16
+    assert det.detector_name == 'FXE_DET_LPD1M-1'
+    assert len(det.train_ids) == 480
+
+    shape = det.buffer_shape('image.data')
+    assert shape == (16, 128, 1, 256, 256)
+    buf = np.zeros(shape, dtype=np.float32)
+
+    tid, arr = next(det.trains(out=buf))
+    assert tid == 10000
+    assert arr.shape == (16, 128, 1, 256, 256)
+    assert arr.base is buf
+
+    _, ref = run.train_from_id(10000, devices=[('*/DET/*', 'image.data')])
+    np.testing.assert_array_equal(
+        arr[3], ref['FXE_DET_LPD1M-1/DET/3CH0:xtdf']['image.data']
+    )
+
+
+def test_lpd_trains_allocate(mock_fxe_run):
+    det = LPD1M(RunDirectory(mock_fxe_run))
+    for tid, arr in islice(det.trains(), 2):
+        assert arr.shape == (16, 128, 1, 256, 256)
+        assert arr.dtype == np.uint16
+
+
+def test_detector_not_found(mock_fxe_run):
+    with pytest.raises(SourceNameError):
+        AGIPD1M(RunDirectory(mock_fxe_run))
+
+
+def test_lpd_missing_module():
+    with TemporaryDirectory() as td:
+        make_examples.make_fxe_run(td)
+        os.unlink(os.path.join(td, 'RAW-R0450-LPD05-S00000.h5'))
+        det = LPD1M(RunDirectory(td))
+        assert 5 not in det.modules
+
+        tid, arr = next(det.trains(fill_value=7))
+        assert arr.shape == (16, 128, 1, 256, 256)
+        assert (arr[5] == 7).all()
+
+
+def test_lpd_trains_processes(mock_fxe_run):
+    det = LPD1M(RunDirectory(mock_fxe_run))
+    seq = list(islice(det.trains(), 3))
+    for (tid, arr), (tid_seq, arr_seq) in zip(det.trains(processes=2), seq):
+        assert tid == tid_seq
+        np.testing.assert_array_equal(arr, arr_seq)
+
+
+def test_lpd_trains_pulses(mock_fxe_run):
+    det = LPD1M(RunDirectory(mock_fxe_run))
+    tid, full = next(det.trains())
+    full = full.copy()
+    tid2, arr = next(det.trains(pulses=by_index[10:14]))
+    assert tid2 == tid
+    assert arr.shape == (16, 4, 1, 256, 256)
+    np.testing.assert_array_equal(arr, full[:, 10:14])
+
+
+def test_lpd_trains_roi(mock_fxe_run):
+    det = LPD1M(RunDirectory(mock_fxe_run))
+    _, full = next(det.trains())
+    full = full.copy()
+
+    roi = by_index[100:120, 200:]
+    assert det.buffer_shape(roi=roi) == (16, 128, 1, 20, 56)
+    buf = np.zeros(det.buffer_shape(roi=roi), dtype=np.float32)
+    _, arr = next(det.trains(out=buf, roi=roi))
+    np.testing.assert_array_equal(arr, full[..., 100:120, 200:])
+
+def test_lpd_roi_one_open_file(mock_fxe_run):
+    det = LPD1M(RunDirectory(mock_fxe_run, max_open_files=1))
+    roi = by_index[0:10, 0:10]
+    assert det.buffer_shape(roi=roi) == (16, 128, 1, 10, 10)
+    _, arr = next(det.trains(roi=roi))
+    assert arr.shape == (16, 128, 1, 10, 10)
@@ -1,12 +1,16 @@
 from itertools import islice
+import numpy as np
+import os.path as osp
 import pandas as pd
+import threading
 import pytest
 from xarray import DataArray
 
 from karabo_data import (
     H5File, RunDirectory, stack_data, stack_detector_data, by_index, by_id,
-    SourceNameError, PropertyNameError,
+    by_cell, SourceNameError, PropertyNameError,
 )
+from karabo_data import reader
 
 
 def test_iterate_trains(mock_agipd_data):
@@ -75,6 +79,30 @@ def test_iterate_trains_select_keys(mock_fxe_control_data):
             assert 'beamPosition.iyPos.value' not in data['SA1_XTD2_XGM/DOOCS/MAIN']
             assert 'SA3_XTD10_VAC/TSENS/S30160K' not in data
 
+def test_read_plan_reused(mock_fxe_control_data):
+    sel = [('SA1_XTD2_XGM/DOOCS/MAIN', 'beamPosition.ixPos')]
+    with H5File(mock_fxe_control_data) as f:
+        for train_id, data in islice(f.trains(devices=sel), 10):
+            assert 'beamPosition.ixPos.value' in data['SA1_XTD2_XGM/DOOCS/MAIN']
+        f.train_from_index(20, devices=sel)
+        assert len(f._read_plans) == 1
+
+        # Closing the file handle must drop the cached datasets
+        f._close_handle()
+        assert not f._read_plans
+        tid, data = f.train_from_id(10020, devices=sel)
+        assert 'beamPosition.ixPos.value' in data['SA1_XTD2_XGM/DOOCS/MAIN']
+
+def test_iterate_trains_all_data_catalog(mock_fxe_control_data):
+    with H5File(mock_fxe_control_data) as f:
+        for train_id, data in islice(f.trains(), 3):
+            xgm_keys = set(data['SA1_XTD2_XGM/DOOCS/MAIN']) - {'metadata'}
+            assert xgm_keys == f._keys_for_source('SA1_XTD2_XGM/DOOCS/MAIN')
+            assert 'data.intensityTD' in data['SA1_XTD2_XGM/DOOCS/MAIN:output']
+
+        assert list(f._read_plans) == [None]
+        assert len(f._dataset_catalog()) > 0
+
 def test_iterate_trains_require_all(mock_sa3_control_data):
     with H5File(mock_sa3_control_data) as f:
         trains_iter = f.trains(devices=[('*/CAM/BEAMVIEW:daqOutput', 'data.image.dims')], require_all=True)
@@ -90,13 +118,62 @@ def test_read_fxe_run(mock_fxe_run):
     assert [tid for tid, _ in run.ordered_trains] == list(range(10000, 10480))
     run.info()  # Smoke test
 
+def test_run_close(mock_fxe_run):
+    import gc, weakref
+    run = RunDirectory(mock_fxe_run)
+    run.train_from_id(10005)
+    file_ref = weakref.ref(run.files[0])
+    del run
+    gc.collect()
+    assert file_ref() is None  # The pool doesn't keep files alive
+
+    with RunDirectory(mock_fxe_run, max_open_files=1) as run:
+        f0, f1 = run.files[:2]
+        with f0._pinned() as h5f:
+            f1.file
+            assert f0._file is h5f  # Not closed while pinned
+        f1.file
+        assert f0._file is None
+    assert all(f._file is None for f in run.files)
+
 def test_properties_fxe_run(mock_fxe_run):
     run = RunDirectory(mock_fxe_run)
 
     assert run.train_ids == list(range(10000, 10480))
+    assert run.train_indices[10005] == 5
+    assert len(run.train_indices) == 480
     assert 'SPB_XTD9_XGM/DOOCS/MAIN' in run.control_sources
     assert 'FXE_DET_LPD1M-1/DET/15CH0:xtdf' in run.instrument_sources
 
+def test_run_max_open_files(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run, max_open_files=3)
+    pool = run.files[0]._pool
+    assert len(pool) <= 3
+
+    for tid, data in islice(run.trains(), 5):
+        assert 'FXE_DET_LPD1M-1/DET/15CH0:xtdf' in data
+        assert 'FXE_XAD_GEC/CAM/CAMERA' in data
+        assert len(pool) <= 3
+    assert sum(f._file is not None for f in run.files) <= 3
+
+    arr = run.get_array('SA1_XTD2_XGM/DOOCS/MAIN:output', 'data.intensityTD')
+    assert arr.shape == (480, 1000)
+
+def test_run_dataframe_one_open_file(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run, max_open_files=1)
+    df = run.get_dataframe([('*_XGM/DOOCS/MAIN', '*')])
+    assert len(df) == 480
+
+def test_open_run_workers(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run, workers=4)
+    assert len(run.files) == 18
+    assert run.train_ids == list(range(10000, 10480))
+    assert all(f._file is None for f in run.files)
+
+    _, data = run.train_from_id(10024)
+    assert 'image.data' in data['FXE_DET_LPD1M-1/DET/15CH0:xtdf']
+    assert 'firmwareVersion.value' in data['FXE_XAD_GEC/CAM/CAMERA']
+
 def test_iterate_fxe_run(mock_fxe_run):
     run = RunDirectory(mock_fxe_run)
 
@@ -108,6 +185,47 @@ def test_iterate_fxe_run(mock_fxe_run):
     assert 'FXE_XAD_GEC/CAM/CAMERA' in data
     assert 'firmwareVersion.value' in data['FXE_XAD_GEC/CAM/CAMERA']
 
+def test_iterate_fxe_run_prefetch(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    sel = [('*/DET/*', 'image.pulseId'), ('*_XGM/*', 'beamPosition.ixPos')]
+    tids = [tid for (tid, _) in run.trains(sel, train_range=by_index[:20])]
+    nthreads = threading.active_count()
+
+    trains_iter = run.trains(sel, train_range=by_index[:20], prefetch=3)
+    tids_prefetched = []
+    for tid, data in trains_iter:
+        tids_prefetched.append(tid)
+        assert 'image.pulseId' in data['FXE_DET_LPD1M-1/DET/15CH0:xtdf']
+    assert tids_prefetched == tids
+
+    # Stopping early shuts down the background thread
+    trains_iter = run.trains(sel, prefetch=3)
+    next(trains_iter)
+    trains_iter.close()
+    assert threading.active_count() == nthreads
+
+    # Errors in the background thread are raised in the caller
+    with pytest.raises(ValueError):
+        next(run.trains(train_range=by_id[9000:9050], prefetch=2))
+
+def test_iterate_fxe_run_processes(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    sel = [('*/DET/0CH0:xtdf', 'image.data'), ('*_XGM/*', 'beamPosition.ixPos')]
+    trains_iter = run.trains(sel, train_range=by_id[10395:10405], processes=2)
+    tids = []
+    for tid, data in trains_iter:
+        tids.append(tid)
+        assert data['FXE_DET_LPD1M-1/DET/0CH0:xtdf']['image.data'].shape \
+               == (128, 1, 256, 256)
+        assert 'beamPosition.ixPos.value' in data['SA1_XTD2_XGM/DOOCS/MAIN']
+    assert tids == list(range(10395, 10405))
+
+    # Stop early
+    trains_iter = run.trains(sel, processes=2)
+    tid, data = next(trains_iter)
+    assert tid == 10000
+    trains_iter.close()
+
 def test_iterate_select_trains(mock_fxe_run):
     run = RunDirectory(mock_fxe_run)
 
@@ -137,6 +255,130 @@ def test_iterate_select_trains(mock_fxe_run):
     tids = [tid for (tid, _) in run.trains(train_range=by_index[4:6])]
     assert tids == [10004, 10005]
 
+def test_run_train_batches(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    sel = [('SA1_XTD2_XGM/DOOCS/MAIN*', 'beamPosition.ixPos'),
+           ('FXE_DET_LPD1M-1/DET/0CH0:xtdf', 'image.pulseId')]
+    xgm = 'SA1_XTD2_XGM/DOOCS/MAIN'
+    lpd = 'FXE_DET_LPD1M-1/DET/0CH0:xtdf'
+
+    # This range spans the two sequence files of control data
+    batches = list(run.train_batches(4, sel, train_range=by_id[10395:10405]))
+    assert [len(b) for b in batches] == [4, 4, 2]
+    assert list(batches[0].train_ids) == [10395, 10396, 10397, 10398]
+
+    batch = batches[1]
+    assert batch.data[xgm]['beamPosition.ixPos.value'].shape == (4,)
+    assert list(batch.offsets[xgm]['beamPosition.ixPos.value']) == [0, 1, 2, 3, 4]
+    assert batch.data[lpd]['image.pulseId'].shape == (4 * 128, 1)
+    assert list(batch.offsets[lpd]['image.pulseId']) == [0, 128, 256, 384, 512]
+
+    tid, data = batch.train(2)
+    tid2, data2 = run.train_from_id(tid, sel)
+    assert tid == tid2 == 10401
+    assert data[xgm]['beamPosition.ixPos.value'] == \
+           data2[xgm]['beamPosition.ixPos.value']
+    assert data[lpd]['image.pulseId'].shape == data2[lpd]['image.pulseId'].shape
+
+def test_file_train_batches(mock_fxe_control_data):
+    with H5File(mock_fxe_control_data) as f:
+        batches = list(f.train_batches(150, [('*_XGM/*', 'beamPosition.ixPos')]))
+        with pytest.raises(ValueError):
+            next(f.train_batches(0))
+    assert [len(b) for b in batches] == [150, 150, 100]
+    assert batches[-1].train_ids[-1] == 10399
+
+def test_train_batches_bad_size(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    for batch_size in (0, -1):
+        with pytest.raises(ValueError):
+            next(run.train_batches(batch_size))
+
+def test_run_batch_from_ids(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    sel = [('SA1_XTD2_XGM/DOOCS/MAIN*', 'beamPosition.ixPos'),
+           ('FXE_DET_LPD1M-1/DET/0CH0:xtdf', 'image.pulseId'),
+           ('FXE_DET_LPD1M-1/DET/0CH0:xtdf', 'image.data')]
+    lpd = 'FXE_DET_LPD1M-1/DET/0CH0:xtdf'
+
+    # Unsorted, with a repeat, across sequence files & with gaps
+    tids = [10450, 10003, 10004, 10399, 10005, 10003, 10100]
+    batch = run.batch_from_ids(np.array(tids), sel)
+    assert list(batch.train_ids) == tids
+    assert batch.data[lpd]['image.data'].shape == (7 * 128, 1, 256, 256)
+
+    for i, tid in enumerate(tids):
+        tid2, data = batch.train(i)
+        _, expected = run.train_from_id(tid, sel)
+        assert tid2 == tid
+        assert data.keys() == expected.keys()
+        for src in expected:
+            for key in expected[src]:
+                np.testing.assert_array_equal(data[src][key], expected[src][key])
+
+    assert len(run.batch_from_ids([], sel)) == 0
+    with pytest.raises(KeyError):
+        run.batch_from_ids([10003, 9999], sel)
+
+    with H5File(osp.join(mock_fxe_run, 'RAW-R0450-DA01-S00000.h5')) as f:
+        batch = f.batch_from_ids([10020, 10010], sel[:1])
+        assert list(batch.train_ids) == [10020, 10010]
+        xgm = batch.data['SA1_XTD2_XGM/DOOCS/MAIN']['beamPosition.ixPos.value']
+        np.testing.assert_array_equal(
+            xgm, f.get_array('SA1_XTD2_XGM/DOOCS/MAIN',
+                             'beamPosition.ixPos.value')[[20, 10]])
+
+
+def test_run_batch_from_ids_duplicate_trains():
+    from tempfile import TemporaryDirectory
+    from .mockdata import write_file
+    from .mockdata.xgm import XGM
+    xgm = 'SA1_XTD2_XGM/DOOCS/MAIN'
+    with TemporaryDirectory() as td:
+        # Trains 10005-10009 are in both files
+        write_file(osp.join(td, 'RAW-R0450-DA01-S00000.h5'), [XGM(xgm)],
+                   ntrains=10)
+        write_file(osp.join(td, 'RAW-R0450-DA01-S00001.h5'), [XGM(xgm)],
+                   ntrains=10, firsttrain=10005)
+        run = RunDirectory(td)
+        sel = [(xgm + '*', 'beamPosition.ixPos'), (xgm + '*', 'data.intensityTD')]
+        batch = run.batch_from_ids(np.arange(10000, 10015), sel)
+
+        # Each train is read once, from the first file with it
+        for src, key in [(xgm, 'beamPosition.ixPos.value'),
+                         (xgm + ':output', 'data.intensityTD')]:
+            assert len(batch.data[src][key]) == 15
+            np.testing.assert_array_equal(np.diff(batch.offsets[src][key]), 1)
+
+def test_train_ids_where(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    xgm = 'SA1_XTD2_XGM/DOOCS/MAIN'
+    cam = 'FXE_XAD_GEC/CAM/CAMERA:daqOutput'
+
+    tids = run.train_ids_where({
+        (cam, 'data.trainId'): lambda t: t % 3 == 0,
+        (xgm, 'beamPosition.ixPos.value'): (None, 0),
+    })
+    assert list(tids) == list(range(10002, 10480, 3))
+
+    tids = run.train_ids_where({
+        (cam, 'data.trainId'): (10395, 10404),
+        (xgm, 'beamPosition.ixPos.value'): lambda x: x == 0,
+    })
+    assert list(tids) == list(range(10395, 10405))
+
+    # Only the matching trains are read
+    sel = [('*/DET/0CH0:xtdf', 'image.pulseId')]
+    assert [t for (t, _) in run.trains(sel, train_range=by_id[tids])] \
+           == list(tids)
+    assert [t for (t, _) in run.trains(sel, train_range=by_index[[3, 1]])] \
+           == [10001, 10003]
+
+    assert len(run.train_ids_where({(xgm, 'beamPosition.ixPos.value'): (1, None),
+                                    (cam, 'data.trainId'): (0, None)})) == 0
+    with pytest.raises(ValueError):
+        run.train_ids_where({(xgm + ':output', 'data.intensityTD'): (0, 1)})
+
 def test_iterate_run_glob_devices(mock_fxe_run):
     run = RunDirectory(mock_fxe_run)
     trains_iter = run.trains([("*/DET/*", "image.data")])
@@ -147,6 +389,15 @@ def test_iterate_run_glob_devices(mock_fxe_run):
     assert 'detector.data' not in data['FXE_DET_LPD1M-1/DET/15CH0:xtdf']
     assert 'FXE_XAD_GEC/CAM/CAMERA' not in data
 
+def test_run_keys_cached(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    keys = run._keys_for_source('SA1_XTD2_XGM/DOOCS/MAIN')
+    assert 'beamPosition.ixPos.value' in keys
+    assert run._keys_for_source('SA1_XTD2_XGM/DOOCS/MAIN') is keys
+
+    sel = run._keys_for_source('FXE_DET_LPD1M-1/DET/0CH0:xtdf')
+    assert {'image.data', 'image.pulseId', 'header.linkId'} <= sel
+
 def test_train_by_id_fxe_run(mock_fxe_run):
     run = RunDirectory(mock_fxe_run)
     _, data = run.train_from_id(10024)
@@ -155,6 +406,17 @@ def test_train_by_id_fxe_run(mock_fxe_run):
     assert 'FXE_XAD_GEC/CAM/CAMERA' in data
     assert 'firmwareVersion.value' in data['FXE_XAD_GEC/CAM/CAMERA']
 
+def test_train_by_id_fxe_run_missing(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    with pytest.raises(KeyError):
+        run.train_from_id(9999)
+    with pytest.raises(ValueError):
+        run.train_info(10480)
+
+    # 16 detector modules + one of the two control data files
+    assert len(run._files_for_train(10479)) == 17
+    assert len(run._files_for_train(10000)) == 17
+
 def test_train_by_id_fxe_run_selection(mock_fxe_run):
     run = RunDirectory(mock_fxe_run)
     _, data = run.train_from_id(10024, [('*/DET/*', 'image.data')])
@@ -209,6 +471,47 @@ def test_run_get_dataframe(mock_fxe_run):
     assert "SA1_XTD2_XGM/DOOCS/MAIN/beamPosition.ixPos" in df2.columns
     assert "SA1_XTD2_XGM/DOOCS/MAIN/beamPosition.ixPos.timestamp" in df2.columns
 
+def test_run_get_dataframe_matches_series(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    df = run.get_dataframe(fields=[("*_XGM/*", "*.i[xy]Pos*")], timestamps=True)
+
+    expected = pd.concat([
+        run.get_series(src, key) for src in
+        ['SA1_XTD2_XGM/DOOCS/MAIN', 'SPB_XTD9_XGM/DOOCS/MAIN']
+        for key in ['beamPosition.ixPos.timestamp', 'beamPosition.ixPos.value',
+                    'beamPosition.iyPos.timestamp', 'beamPosition.iyPos.value']
+    ], axis=1)
+    pd.testing.assert_frame_equal(df[expected.columns], expected,
+                                  check_names=False)
+
+def test_get_dataframe_pulse_data(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    src = 'FXE_DET_LPD1M-1/DET/0CH0:xtdf'
+    df = run.get_dataframe(fields=[(src, 'image.length')])
+    assert df.shape == (480 * 128, 1)
+    assert df.index.names == ['trainId', 'pulseId']
+    pd.testing.assert_series_equal(df[src + '/image.length'],
+                                   run.get_series(src, 'image.length'))
+
+    with H5File(osp.join(mock_fxe_run, 'RAW-R0450-LPD00-S00000.h5')) as f:
+        df = f.get_dataframe(fields=[(src, 'image.length')])
+        assert df.shape == (len(f.train_ids) * 128, 1)
+        assert df.index.names == ['trainId', 'pulseId']
+
+def test_get_dataframe_pulse_data_errors(mock_agipd_data, mock_lpd_data):
+    src = 'SPB_DET_AGIPD1M-1/DET/7CH0:xtdf'
+    with H5File(mock_agipd_data) as f:
+        with pytest.raises(ValueError, match="Can't mix"):
+            f.get_dataframe(fields=[(src, 'image.cellId'),
+                                    (src, 'header.pulseCount')])
+
+    # Pulse IDs in the mock data are all 0, so they can't be aligned
+    src = 'FXE_DET_LPD1M-1/DET/0CH0:xtdf'
+    with H5File(mock_lpd_data) as f:
+        with pytest.raises(ValueError, match="repeated"):
+            f.get_dataframe(fields=[(src, 'image.cellId'),
+                                    (src, 'image.length')])
+
 def test_file_get_array(mock_fxe_control_data):
     with H5File(mock_fxe_control_data) as f:
         arr = f.get_array('FXE_XAD_GEC/CAM/CAMERA:daqOutput', 'data.image.pixels')
@@ -258,3 +561,278 @@ def test_stack_detector_data(mock_fxe_run):
 
     comb = stack_detector_data(data, 'image.data')
     assert comb.shape == (128, 1, 16, 256, 256)
+
+def test_data_counts_fxe_run(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    counts = run.data_counts()
+    assert counts.shape == (480, 72)
+    assert list(counts.index) == run.train_ids
+    assert (counts['FXE_DET_LPD1M-1/DET/0CH0:xtdf/image'] == 128).all()
+    assert (counts['FXE_XAD_GEC/CAM/CAMERA_NODATA:daqOutput/data'] == 0).all()
+
+    counts = run.data_counts([('SA1_XTD2_XGM/DOOCS/MAIN*', '*')])
+    assert list(counts.columns) == [
+        'SA1_XTD2_XGM/DOOCS/MAIN', 'SA1_XTD2_XGM/DOOCS/MAIN:output/data'
+    ]
+
+def test_iterate_fxe_run_require_all(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    sel = [('FXE_XAD_GEC/CAM/CAMERA_NODATA:daqOutput', 'data.image.pixels')]
+    assert list(run.trains(devices=sel, require_all=True)) == []
+
+    sel = [('SA1_XTD2_XGM/DOOCS/MAIN:output', 'data.*'),
+           ('*/DET/4CH0:xtdf', 'image.pulseId')]
+    tids = [t for (t, _) in run.trains(devices=sel, require_all=True,
+                                       train_range=by_index[5:10])]
+    assert tids == list(range(10005, 10010))
+
+def test_train_pulse_selection(mock_agipd_data):
+    src = 'SPB_DET_AGIPD1M-1/DET/7CH0:xtdf'
+    with H5File(mock_agipd_data) as f:
+        _, full = f.train_from_index(3)
+        full = full[src]
+
+        _, data = f.train_from_index(3, pulses=by_cell[4:8])
+        assert data[src]['image.data'].shape == (4,) + full['image.data'].shape[1:]
+        np.testing.assert_array_equal(data[src]['image.cellId'][:, 0], [4, 5, 6, 7])
+        np.testing.assert_array_equal(data[src]['image.data'],
+                                      full['image.data'][4:8])
+
+        pulse_ids = full['image.pulseId'][[1, 5, 9], 0]
+        _, data = f.train_from_index(3, pulses=by_id[pulse_ids])
+        np.testing.assert_array_equal(data[src]['image.pulseId'][:, 0], pulse_ids)
+
+        _, data = f.train_from_index(3, pulses=by_index[[0, 2, 3]])
+        np.testing.assert_array_equal(data[src]['image.data'],
+                                      full['image.data'][[0, 2, 3]])
+
+        _, data = f.train_from_index(3, pulses=by_index[[-1]])
+        np.testing.assert_array_equal(data[src]['image.data'],
+                                      full['image.data'][[-1]])
+        with pytest.raises(IndexError):
+            f.train_from_index(3, pulses=by_index[[0, 10000]])
+
+        tid, data = next(f.trains(pulses=by_index[::16]))
+        assert data[src]['image.data'].shape[0] == 4
+
+def test_roi_fxe_run(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    cam = 'FXE_XAD_GEC/CAM/CAMERA:daqOutput'
+    full = run.get_array(cam, 'data.image.pixels')
+    arr = run.get_array(cam, 'data.image.pixels', roi=by_index[10:20, 5:8])
+    assert arr.shape == (full.shape[0], 10, 3)
+    np.testing.assert_array_equal(arr.values, full.values[:, 10:20, 5:8])
+
+    sel = [('*/DET/2CH0:xtdf', 'image.*')]
+    _, data = run.train_from_index(1, devices=sel)
+    tid, roi_data = next(run.trains(devices=sel, roi=by_index[:32, :16],
+                                    train_range=by_index[1:]))
+    mod = 'FXE_DET_LPD1M-1/DET/2CH0:xtdf'
+    assert roi_data[mod]['image.data'].shape == (128, 1, 32, 16)
+    np.testing.assert_array_equal(roi_data[mod]['image.data'],
+                                  data[mod]['image.data'][..., :32, :16])
+    # Data with 1 dimension per entry isn't affected
+    assert roi_data[mod]['image.pulseId'].shape == (128, 1)
+
+def test_get_dask_array_fxe_run(mock_fxe_run):
+    pytest.importorskip('dask')
+    run = RunDirectory(mock_fxe_run, max_open_files=2)
+    src = 'FXE_DET_LPD1M-1/DET/3CH0:xtdf'
+    arr = run.get_dask_array(src, 'image.data')
+    assert arr.shape == (480 * 128, 1, 256, 256)
+    assert arr.dims[0] == 'trainId'
+    np.testing.assert_array_equal(arr.coords['trainId'][:3], [10000] * 3)
+
+    _, data = run.train_from_id(10002, devices=[(src, 'image.data')])
+    np.testing.assert_array_equal(arr.sel(trainId=10002).values,
+                                  data[src]['image.data'])
+
+    # Chunks don't cross the boundary between sequence files
+    xgm = run.get_dask_array('SA1_XTD2_XGM/DOOCS/MAIN', 'beamPosition.ixPos.value')
+    assert xgm.shape == (480,)
+    assert xgm.chunks == ((400, 80),)
+    np.testing.assert_array_equal(
+        xgm.values, run.get_array('SA1_XTD2_XGM/DOOCS/MAIN',
+                                  'beamPosition.ixPos.value').values
+    )
+
+def test_get_array_per_pulse(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    src = 'FXE_DET_LPD1M-1/DET/0CH0:xtdf'
+    arr = run.get_array(src, 'image.data', per_pulse=True,
+                        train_range=by_id[10398:10402])
+    assert arr.dims == ('train_pulse', 'dim_0', 'dim_1', 'dim_2')
+    assert arr.shape == (4 * 128, 1, 256, 256)
+
+    _, data = run.train_from_id(10400, devices=[(src, 'image.data')])
+    np.testing.assert_array_equal(arr.sel(trainId=10400).values,
+                                  data[src]['image.data'])
+
+    s = run.get_series(src, 'image.length')
+    lengths = run.get_array(src, 'image.length', per_pulse=True)
+    assert list(lengths.indexes['train_pulse']) == list(s.index)
+    np.testing.assert_array_equal(lengths.values[:, 0], s.values)
+
+    with pytest.raises(ValueError):
+        run.get_array(src, 'image.data')
+    with pytest.raises(ValueError):
+        run.get_array('SA1_XTD2_XGM/DOOCS/MAIN', 'beamPosition.ixPos.value',
+                      per_pulse=True)
+
+def test_get_array_per_pulse_old_xarray(mock_fxe_run, monkeypatch):
+    import xarray as xr
+    # xarray before 2023.08 has no Coordinates.from_pandas_multiindex
+    if hasattr(xr, 'Coordinates'):
+        monkeypatch.delattr(xr.Coordinates, 'from_pandas_multiindex',
+                            raising=False)
+    run = RunDirectory(mock_fxe_run)
+    src = 'FXE_DET_LPD1M-1/DET/0CH0:xtdf'
+    lengths = run.get_array(src, 'image.length', per_pulse=True,
+                            train_range=by_id[10398:10402])
+    assert lengths.dims[0] == 'train_pulse'
+    assert lengths.sel(trainId=10400).shape == (128, 1)
+
+def test_iterate_preload_control(mock_fxe_run, monkeypatch):
+    run = RunDirectory(mock_fxe_run)
+    sel = [('SA1_XTD2_XGM/*', 'beamPosition.*'), ('*/CAM/CAMERA:*', 'data.*')]
+    expected = list(run.trains(devices=sel, train_range=by_id[10395:10405]))
+
+    def check(trains):
+        assert [tid for (tid, _) in trains] == list(range(10395, 10405))
+        for (_, data), (_, exp_data) in zip(trains, expected):
+            assert data.keys() == exp_data.keys()
+            for src in data:
+                for key in exp_data[src]:
+                    if key != 'metadata':
+                        np.testing.assert_array_equal(data[src][key],
+                                                      exp_data[src][key])
+
+    check(list(run.trains(devices=sel, train_range=by_id[10395:10405],
+                          preload_control=True)))
+    # A number of bytes sets the limit
+    check(list(run.trains(devices=sel, train_range=by_id[10395:10405],
+                          preload_control=1000)))
+    with pytest.raises(ValueError):
+        next(run.trains(devices=sel, preload_control=-1))
+
+    with H5File(osp.join(mock_fxe_run, 'RAW-R0450-DA01-S00000.h5')) as f:
+        src, key = 'SA1_XTD2_XGM/DOOCS/MAIN', 'beamPosition.ixPos.value'
+        assert (src, key) in f._preload_control()
+        # Over the memory limit, data is read from the file as usual
+        monkeypatch.setattr(reader, 'CONTROL_PRELOAD_MAX_BYTES', 1000)
+        assert (src, key) not in f._preload_control()
+        tid, data = next(f.trains(devices=sel, preload_control=True))
+        assert data[src][key] == f.get_array(src, key)[0]
+        monkeypatch.undo()
+
+        preload = f._preload_control
+        calls = []
+        monkeypatch.setattr(f, '_preload_control', lambda *args: calls.append(
+            args) or preload(*args))
+        tid, data = next(f.trains(devices=sel, preload_control=1000))
+        assert calls[0][1] == 1000
+        assert data[src][key] == f.get_array(src, key)[0]
+
+    with pytest.raises(ValueError):
+        next(run.trains(preload_control=True, processes=2))
+
+def test_train_cache(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run, train_cache_bytes=40 * 1024 * 1024)
+    sel = [('*/DET/0CH0:xtdf', 'image.data')]
+    src = 'FXE_DET_LPD1M-1/DET/0CH0:xtdf'
+    _, data = run.train_from_id(10005, devices=sel)
+    _, data2 = run.train_from_index(5, devices=sel)
+    assert data2 is not data
+    assert data2[src]['image.data'] is data[src]['image.data']
+    assert (run.train_cache.hits, run.train_cache.misses) == (1, 1)
+
+    # 16 modules is 256 MiB per train, so it's too big for the cache
+    _, data = run.train_from_id(10005, devices=[('*/DET/*', 'image.data')])
+    assert len(run.train_cache) == 1
+
+    # Least recently used trains are dropped (16 MiB per train)
+    for tid in range(10006, 10010):
+        run.train_from_id(tid, devices=sel)
+    assert run.train_cache.nbytes <= 40 * 1024 * 1024
+    assert len(run.train_cache) == 2
+    run.train_from_id(10005, devices=sel)
+    assert run.train_cache.misses == 7
+
+    # Equivalent selections share a cache entry
+    run.train_cache.clear()
+    sel = [('*_XGM/*', 'beamPosition.ixPos'), ('*/CAM/*', 'firmwareVersion')]
+    run.train_from_id(10005, devices=set(sel))
+    run.train_from_id(10005, devices=set(reversed(sel)))
+    run.train_from_id(10005, devices=sel)
+    run.train_from_id(10005, devices=sel[::-1])
+    run.train_from_id(10005, devices={'SA1_XTD2_XGM/DOOCS/MAIN': None})
+    run.train_from_id(10005, devices={'SA1_XTD2_XGM/DOOCS/MAIN': set()})
+    assert (run.train_cache.hits, run.train_cache.misses) == (3, 3)
+
+    # A set holds exact pairs, but a list holds glob patterns: don't mix them
+    run.train_cache.clear()
+    sel = [('*_XGM/*', 'beamPosition.ixPos')]
+    _, data = run.train_from_id(10005, devices=set(sel))
+    assert data == {}
+    _, data = run.train_from_id(10005, devices=sel)
+    assert 'SA1_XTD2_XGM/DOOCS/MAIN' in data
+
+def test_dask_array_threads_small_pool(mock_fxe_run, monkeypatch):
+    pytest.importorskip('dask')
+    monkeypatch.setattr(reader, 'DASK_CHUNK_BYTES', 1)  # Many small chunks
+    run = RunDirectory(mock_fxe_run, max_open_files=1)
+    src, key = 'SA1_XTD2_XGM/DOOCS/MAIN:output', 'data.intensityTD'
+    arr = run.get_dask_array(src, key)
+    assert len(arr.data.chunks[0]) > 2
+    expected = run.get_array(src, key).values
+
+    # Reading chunks of the 2 files in parallel closes files constantly
+    for _ in range(10):
+        res = arr.data.compute(scheduler='threads', num_workers=4)
+        np.testing.assert_array_equal(res, expected)
+
+def test_run_get_array_matches_files(mock_fxe_run):
+    import xarray as xr
+    run = RunDirectory(mock_fxe_run)
+    src, key = 'SA1_XTD2_XGM/DOOCS/MAIN:output', 'data.intensityTD'
+    arr = run.get_array(src, key)
+    per_file = xr.concat([f.get_array(src, key) for f in run.files
+                          if src in f.all_sources], dim='trainId')
+    per_file = per_file.sortby('trainId')
+    xr.testing.assert_identical(arr, per_file)
+
+    s = run.get_series('FXE_DET_LPD1M-1/DET/0CH0:xtdf', 'image.length')
+    assert s.index.names == ['trainId', 'pulseId']
+    assert len(s) == 480 * 128
+
+def test_train_range_fields_fxe_run(mock_fxe_run):
+    run = RunDirectory(mock_fxe_run)
+    src, key = 'SA1_XTD2_XGM/DOOCS/MAIN', 'beamPosition.ixPos.value'
+    full = run.get_series(src, key)
+
+    s = run.get_series(src, key, train_range=by_index[::10])
+    assert list(s.index) == list(range(10000, 10480, 10))
+    np.testing.assert_array_equal(s.values, full.values[::10])
+
+    arr = run.get_array(src, key, train_range=by_id[10395:10405])
+    assert list(arr.coords['trainId']) == list(range(10395, 10405))
+
+    df = run.get_dataframe(fields=[(src, '*.ixPos')],
+                           train_range=by_id[10410:10420])
+    assert list(df.index) == list(range(10410, 10420))
+
+    # A negative step selects the same trains, returned in train ID order
+    arr = run.get_array(src, key, train_range=by_index[::-100])
+    assert list(arr.coords['trainId']) == list(range(10079, 10480, 100))
+    np.testing.assert_array_equal(arr.values, full.values[79::100])
+    df = run.get_dataframe(fields=[(src, '*.ixPos')],
+                           train_range=by_index[::-100])
+    assert list(df.index) == list(range(10079, 10480, 100))
+
+    s = run.get_series('FXE_DET_LPD1M-1/DET/0CH0:xtdf', 'image.length',
+                       train_range=by_id[10001:10003])
+    assert len(s) == 2 * 128
+
+    with H5File(osp.join(mock_fxe_run, 'RAW-R0450-DA01-S00000.h5')) as f:
+        arr = f.get_array(src, key, train_range=by_index[5:8])
+        assert list(arr.coords['trainId']) == [10005, 10006, 10007]
@@ -0,0 +1,118 @@
+import numpy as np
+import os
+import os.path as osp
+from tempfile import TemporaryDirectory
+
+from karabo_data import RunDirectory, by_id
+from karabo_data.run_files_map import RunFilesMap, MAP_FILENAME
+from . import make_examples
+
+
+def test_run_map_reopen():
+    with TemporaryDirectory() as td:
+        make_examples.make_fxe_run(td)
+
+        run = RunDirectory(td, use_run_map=True)
+        assert osp.isfile(osp.join(td, MAP_FILENAME))
+        assert len(run.files) == 18
+
+        run2 = RunDirectory(td, use_run_map=True)
+        assert run2.train_ids == run.train_ids
+        assert run2.control_sources == run.control_sources
+        assert run2.instrument_sources == run.instrument_sources
+        # Files from the map are only opened when we read data
+        assert all(f._file is None for f in run2.files)
+
+        _, data = run2.train_from_id(10024, devices=[('*/DET/*', 'image.data')])
+        assert 'image.data' in data['FXE_DET_LPD1M-1/DET/15CH0:xtdf']
+        s = run2.get_series('SA1_XTD2_XGM/DOOCS/MAIN', 'beamPosition.iyPos.value')
+        assert len(s) == 480
+
+
+def test_run_map_outdated():
+    with TemporaryDirectory() as td:
+        make_examples.make_fxe_run(td)
+        RunDirectory(td, use_run_map=True)
+
+        path = osp.join(td, 'RAW-R0450-DA01-S00000.h5')
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+
+        run_map = RunFilesMap(td)
+        assert run_map.get(path) is None
+        assert run_map.get(osp.join(td, 'RAW-R0450-DA01-S00001.h5')) is not None
+
+
+def test_run_map_corrupt():
+    with TemporaryDirectory() as td:
+        make_examples.make_fxe_run(td)
+        map_path = osp.join(td, MAP_FILENAME)
+        with open(map_path, 'wb') as f:
+            f.write(b'not a zip file')
+
+        run = RunDirectory(td, use_run_map=True)
+        assert len(run.files) == 18
+        s = run.get_series('SA1_XTD2_XGM/DOOCS/MAIN', 'beamPosition.iyPos.value')
+        assert len(s) == 480
+
+        # A map with metadata but missing arrays is also ignored
+        with np.load(map_path) as npz:
+            meta = npz['meta']
+        np.savez(map_path, meta=meta)
+        run_map = RunFilesMap(td)
+        assert run_map.files_data == {}
+        assert run_map.loaded_from is None
+        run = RunDirectory(td, use_run_map=True)
+        assert run.train_ids == list(range(10000, 10480))
+
+
+def test_run_map_train_range_skips_files():
+    with TemporaryDirectory() as td:
+        make_examples.make_fxe_run(td)
+        RunDirectory(td, use_run_map=True)
+        run = RunDirectory(td, use_run_map=True)
+
+        sel = [('SA1_XTD2_XGM/DOOCS/MAIN', 'beamPosition.ixPos')]
+        tids = [t for (t, _) in run.trains(devices=sel,
+                                           train_range=by_id[10405:10410])]
+        assert tids == list(range(10405, 10410))
+        opened = [osp.basename(f.path) for f in run.files if f._file is not None]
+        assert opened == ['RAW-R0450-DA01-S00001.h5']
+
+
+def test_run_map_get_array_train_range_skips_files():
+    with TemporaryDirectory() as td:
+        make_examples.make_fxe_run(td)
+        RunDirectory(td, use_run_map=True)
+        run = RunDirectory(td, use_run_map=True)
+
+        arr = run.get_array('SA1_XTD2_XGM/DOOCS/MAIN', 'beamPosition.ixPos.value',
+                            train_range=by_id[10420:10440])
+        assert len(arr) == 20
+        opened = [osp.basename(f.path) for f in run.files if f._file is not None]
+        assert opened == ['RAW-R0450-DA01-S00001.h5']
+
+
+def test_run_map_workers_no_rescan(monkeypatch):
+    from karabo_data.reader import H5File
+    walks = []
+    orig_catalog = H5File._dataset_catalog
+
+    def counting_catalog(self):
+        walks.append(self.path)
+        return orig_catalog(self)
+
+    with TemporaryDirectory() as td:
+        make_examples.make_fxe_run(td)
+        monkeypatch.setattr(H5File, '_dataset_catalog', counting_catalog)
+        run = RunDirectory(td, use_run_map=True, workers=2)
+        assert osp.isfile(osp.join(td, MAP_FILENAME))
+        # Keys were found in the workers, so the main process needn't
+        # look through the files again to save the map.
+        assert walks == []
+        assert all(f._file is None for f in run.files)
+
+        run2 = RunDirectory(td, use_run_map=True)
+        assert run2.train_ids == run.train_ids
+        assert run2._keys_for_source('SA1_XTD2_XGM/DOOCS/MAIN') \
+            == run._keys_for_source('SA1_XTD2_XGM/DOOCS/MAIN')
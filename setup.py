@@ -52,12 +52,16 @@ setup(name="karabo_data",
           'xarray',
       ],
       extras_require={
+          'dask': [
+              'dask[array]',
+          ],
           'docs': [
               'sphinx',
               'nbsphinx',
               'ipython',  # For nbsphinx syntax highlighting
           ],
           'test': [
+              'dask[array]',
               'pytest',
               'pytest-cov',
               'nbval',